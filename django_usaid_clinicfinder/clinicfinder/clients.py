@@ -0,0 +1,284 @@
+import math
+import threading
+import time
+from StringIO import StringIO
+
+import requests
+from go_http.send import HttpApiSender
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from suds.cache import ObjectCache
+from suds.client import Client
+from suds.transport import Transport, TransportError, Reply
+from django.conf import settings
+from django.core.cache import cache
+
+
+class AATClient(object):
+
+    """
+    Per-worker AAT API client sharing one keep-alive connection pool,
+    with timeouts, retries and a circuit breaker that fails fast once
+    AAT_CIRCUIT_THRESHOLD requests in a row have failed
+    """
+
+    class Unavailable(Exception):
+
+        """
+        AAT has been failing and requests are not being attempted
+        until AAT_CIRCUIT_RESET seconds have passed.
+        """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.session = None
+        self.failures = 0
+        self.opened_at = None
+
+    def get_session(self):
+        if self.session is None:
+            retries = Retry(
+                total=settings.AAT_RETRIES,
+                backoff_factor=settings.AAT_RETRY_BACKOFF,
+                status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(
+                pool_maxsize=settings.AAT_POOL_SIZE, max_retries=retries)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.verify = False
+            self.session = session
+        return self.session
+
+    def is_open(self):
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.time() - self.opened_at >= settings.AAT_CIRCUIT_RESET:
+                # Let one request through to see if AAT has recovered
+                self.opened_at = time.time()
+                return False
+            return True
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= settings.AAT_CIRCUIT_THRESHOLD:
+                self.opened_at = time.time()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def get_json(self, url):
+        if self.is_open():
+            raise self.Unavailable("AAT circuit open after %s failures" %
+                                   self.failures)
+        try:
+            response = self.get_session().get(url, timeout=(
+                settings.AAT_CONNECT_TIMEOUT, settings.AAT_READ_TIMEOUT))
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError):
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+aat_client = AATClient()
+
+
+class RequestsTransport(Transport):
+
+    """
+    suds transport sending over a pooled keep-alive requests session
+    instead of a new urllib2 connection per call
+    """
+
+    def __init__(self, session, timeout):
+        Transport.__init__(self)
+        self.session = session
+        self.timeout = timeout
+
+    def open(self, request):
+        response = self.session.get(request.url, timeout=self.timeout)
+        if response.status_code >= 400:
+            raise TransportError(response.reason, response.status_code,
+                                 StringIO(response.content))
+        return StringIO(response.content)
+
+    def send(self, request):
+        response = self.session.post(
+            request.url, data=request.message, headers=request.headers,
+            timeout=self.timeout)
+        if response.status_code in (202, 204):
+            return None
+        if response.status_code >= 400:
+            raise TransportError(response.reason, response.status_code,
+                                 StringIO(response.content))
+        return Reply(response.status_code, response.headers,
+                     response.content)
+
+    def __deepcopy__(self, memo={}):
+        # Cloned clients share the connection pool
+        return RequestsTransport(self.session, self.timeout)
+
+
+class LBSClient(object):
+
+    """
+    Per-worker LBS SOAP client. The WSDL is parsed once per process and
+    cached on disk between processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.client = None
+        self.local = threading.local()
+
+    def build_client(self):
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(
+            pool_maxsize=settings.LBS_API_POOL_SIZE))
+        session.mount("https://", HTTPAdapter(
+            pool_maxsize=settings.LBS_API_POOL_SIZE))
+        cache = ObjectCache(location=settings.LBS_API_WSDL_CACHE,
+                            days=settings.LBS_API_WSDL_CACHE_DAYS)
+        return Client(settings.LBS_API_WSDL, cache=cache,
+                      transport=RequestsTransport(
+                          session, settings.LBS_API_TIMEOUT))
+
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = self.build_client()
+            return self.client
+
+    def get_thread_client(self):
+        """
+        Returns a client for the calling thread. suds clients keep state
+        between calls, so threads use clones sharing the parsed WSDL and
+        connection pool.
+        """
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.get_client().clone()
+        return client
+
+lbs_client = LBSClient()
+
+
+class RateLimiter(object):
+
+    """
+    Token bucket allowing LBS_API_RATE_LIMIT calls a second across all
+    workers, in bursts of up to LBS_API_RATE_BURST. The bucket is kept
+    in the shared cache and updated under a cache lock.
+    """
+    KEY = "clinicfinder.lbs.rate"
+    LOCK_KEY = "clinicfinder.lbs.rate.lock"
+    LOCK_TIMEOUT = 5  # seconds before a lock left by a dead worker goes
+    LOCK_POLL = 0.002  # seconds between attempts to take the lock
+
+    def reset(self):
+        cache.delete_many([self.KEY, self.LOCK_KEY])
+
+    def take(self, rate, burst):
+        # Callers hold the lock
+        now = time.time()
+        tokens, updated = cache.get(self.KEY) or (burst, now)
+        # Going below zero queues callers in the order they arrived
+        tokens = min(burst, tokens + (now - updated) * rate) - 1
+        # Kept until the bucket would have filled up again
+        cache.set(self.KEY, (tokens, now),
+                  int(math.ceil((burst - tokens) / rate)) + 1)
+        return max(0, -tokens / rate)
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until one is available. Returns the
+        seconds waited.
+        """
+        rate = settings.LBS_API_RATE_LIMIT
+        if not rate:
+            return 0
+        while not cache.add(self.LOCK_KEY, True, self.LOCK_TIMEOUT):
+            time.sleep(self.LOCK_POLL)
+        try:
+            wait = self.take(float(rate), settings.LBS_API_RATE_BURST)
+        finally:
+            cache.delete(self.LOCK_KEY)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+lbs_rate_limiter = RateLimiter()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+
+    """
+    HTTPAdapter applying a default timeout to requests made without one,
+    as go_http does
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+class VumiClient(object):
+
+    """
+    Per-worker Vumi Go HTTP API client. Senders share one keep-alive
+    connection pool with timeouts, and retry with backoff when Vumi Go
+    cannot be reached or answers with a gateway error.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.session = None
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                # Read errors are not retried, the message may have gone
+                retries = Retry(
+                    total=settings.VUMI_GO_RETRIES, read=0,
+                    backoff_factor=settings.VUMI_GO_RETRY_BACKOFF,
+                    status_forcelist=[502, 503, 504])
+                adapter = TimeoutHTTPAdapter(
+                    timeout=(settings.VUMI_GO_CONNECT_TIMEOUT,
+                             settings.VUMI_GO_READ_TIMEOUT),
+                    pool_maxsize=settings.VUMI_GO_POOL_SIZE,
+                    max_retries=retries)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+            return self.session
+
+    def get_sender(self):
+        return HttpApiSender(
+            account_key=settings.VUMI_GO_ACCOUNT_KEY,
+            conversation_key=settings.VUMI_GO_CONVERSATION_KEY,
+            conversation_token=settings.VUMI_GO_ACCOUNT_TOKEN,
+            api_url=settings.VUMI_GO_API_URL,
+            session=self.get_session())
+
+vumi_client = VumiClient()
@@ -0,0 +1,333 @@
+"""
+Local stand-in HTTP services for exercising the external hops (AAT,
+LBS SOAP, Vumi Go) in tests and benchmarks without the real services.
+"""
+import json
+import random
+import socket
+import threading
+import time
+import urlparse
+import uuid
+import BaseHTTPServer
+import SocketServer
+
+
+class FakeServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive so clients can reuse connections
+    protocol_version = "HTTP/1.1"
+    # Buffer each response into one write, small writes stall on Nagle
+    wbufsize = -1
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        status, content_type, content = self.server.service.handle(
+            self.command, self.path, body, self.client_address)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PUT = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        # Tracked so stop() can end idle keep-alive connections
+        self.connections.append(request)
+        SocketServer.ThreadingMixIn.process_request(
+            self, request, client_address)
+
+
+class FakeService(object):
+
+    """
+    HTTP service on a random local port. respond is called with
+    (method, path, body) and returns (status, content_type, content).
+    Every request waits latency seconds and fails with a 500 at the
+    given error_rate.
+    """
+
+    def __init__(self, respond, latency=0, error_rate=0):
+        self.respond = respond
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = []
+        self.server = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s" % self.server.server_address[1]
+
+    def handle(self, method, path, body, client_address):
+        self.requests.append((client_address, method, path, body))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, "text/plain", "Fake service error"
+        return self.respond(method, path, body)
+
+    def start(self):
+        self.server = FakeHTTPServer(("127.0.0.1", 0), FakeServiceHandler)
+        self.server.service = self
+        self.server.connections = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for connection in self.server.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+LBS_WSDL = """<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:s="http://www.w3.org/2001/XMLSchema"
+    xmlns:tns="http://lbs.example.com/"
+    xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+    targetNamespace="http://lbs.example.com/">
+  <wsdl:types>
+    <s:schema elementFormDefault="qualified"
+        targetNamespace="http://lbs.example.com/">
+      <s:complexType name="Result">
+        <s:sequence>
+          <s:element name="x" type="s:string" minOccurs="0"/>
+          <s:element name="y" type="s:string" minOccurs="0"/>
+        </s:sequence>
+        <s:attribute name="code" type="s:string"/>
+        <s:attribute name="message" type="s:string"/>
+      </s:complexType>
+      <s:complexType name="ResultList">
+        <s:sequence>
+          <s:element name="Result" type="tns:Result"
+              minOccurs="0" maxOccurs="unbounded"/>
+        </s:sequence>
+      </s:complexType>
+      <s:element name="GetLocation">
+        <s:complexType>
+          <s:sequence>
+            <s:element name="username" type="s:string" minOccurs="0"/>
+            <s:element name="password" type="s:string" minOccurs="0"/>
+            <s:element name="msisdn" type="s:string" minOccurs="0"/>
+          </s:sequence>
+        </s:complexType>
+      </s:element>
+      <s:element name="GetLocationResponse">
+        <s:complexType>
+          <s:sequence>
+            <s:element name="GetLocationResult" type="tns:ResultList"
+                minOccurs="0"/>
+          </s:sequence>
+        </s:complexType>
+      </s:element>
+      <s:element name="AddAllowedMsisdn">
+        <s:complexType>
+          <s:sequence>
+            <s:element name="username" type="s:string" minOccurs="0"/>
+            <s:element name="password" type="s:string" minOccurs="0"/>
+            <s:element name="msisdn" type="s:string" minOccurs="0"/>
+            <s:element name="permissionType" type="s:int"/>
+          </s:sequence>
+        </s:complexType>
+      </s:element>
+      <s:element name="AddAllowedMsisdnResponse">
+        <s:complexType>
+          <s:sequence>
+            <s:element name="AddAllowedMsisdnResult" type="tns:ResultList"
+                minOccurs="0"/>
+          </s:sequence>
+        </s:complexType>
+      </s:element>
+    </s:schema>
+  </wsdl:types>
+  <wsdl:message name="GetLocationSoapIn">
+    <wsdl:part name="parameters" element="tns:GetLocation"/>
+  </wsdl:message>
+  <wsdl:message name="GetLocationSoapOut">
+    <wsdl:part name="parameters" element="tns:GetLocationResponse"/>
+  </wsdl:message>
+  <wsdl:message name="AddAllowedMsisdnSoapIn">
+    <wsdl:part name="parameters" element="tns:AddAllowedMsisdn"/>
+  </wsdl:message>
+  <wsdl:message name="AddAllowedMsisdnSoapOut">
+    <wsdl:part name="parameters" element="tns:AddAllowedMsisdnResponse"/>
+  </wsdl:message>
+  <wsdl:portType name="LBSServiceSoap">
+    <wsdl:operation name="GetLocation">
+      <wsdl:input message="tns:GetLocationSoapIn"/>
+      <wsdl:output message="tns:GetLocationSoapOut"/>
+    </wsdl:operation>
+    <wsdl:operation name="AddAllowedMsisdn">
+      <wsdl:input message="tns:AddAllowedMsisdnSoapIn"/>
+      <wsdl:output message="tns:AddAllowedMsisdnSoapOut"/>
+    </wsdl:operation>
+  </wsdl:portType>
+  <wsdl:binding name="LBSServiceSoap" type="tns:LBSServiceSoap">
+    <soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+    <wsdl:operation name="GetLocation">
+      <soap:operation soapAction="http://lbs.example.com/GetLocation"
+          style="document"/>
+      <wsdl:input><soap:body use="literal"/></wsdl:input>
+      <wsdl:output><soap:body use="literal"/></wsdl:output>
+    </wsdl:operation>
+    <wsdl:operation name="AddAllowedMsisdn">
+      <soap:operation soapAction="http://lbs.example.com/AddAllowedMsisdn"
+          style="document"/>
+      <wsdl:input><soap:body use="literal"/></wsdl:input>
+      <wsdl:output><soap:body use="literal"/></wsdl:output>
+    </wsdl:operation>
+  </wsdl:binding>
+  <wsdl:service name="LBSService">
+    <wsdl:port name="LBSServiceSoap" binding="tns:LBSServiceSoap">
+      <soap:address location="%(url)s"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+"""
+
+LBS_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <%(operation)sResponse xmlns="http://lbs.example.com/">
+      <%(operation)sResult>
+        <Result code="%(code)s" message="%(message)s">
+          <x>%(x)s</x>
+          <y>%(y)s</y>
+        </Result>
+      </%(operation)sResult>
+    </%(operation)sResponse>
+  </soap:Body>
+</soap:Envelope>
+"""
+
+
+class FakeLBS(object):
+
+    """
+    Stand-in LBS SOAP API serving its own WSDL. Every MSISDN is found
+    at x, y, moved by up to jitter degrees, with the given result code.
+    """
+
+    def __init__(self, x=17.914581, y=-32.746124, code="101", latency=0,
+                 error_rate=0, jitter=0):
+        self.x = x
+        self.y = y
+        self.jitter = jitter
+        self.code = code
+        self.service = FakeService(self.respond, latency, error_rate)
+
+    @property
+    def wsdl_url(self):
+        return self.service.url + "/lbsservice.asmx?WSDL"
+
+    def respond(self, method, path, body):
+        if method == "GET":
+            return 200, "text/xml", LBS_WSDL % {
+                "url": self.service.url + "/lbsservice.asmx"}
+        if "AddAllowedMsisdn" in body:
+            operation = "AddAllowedMsisdn"
+        else:
+            operation = "GetLocation"
+        return 200, "text/xml; charset=utf-8", LBS_RESPONSE % {
+            "operation": operation, "code": self.code,
+            "message": "Fake %s result" % operation,
+            "x": self.x + random.uniform(-self.jitter, self.jitter),
+            "y": self.y + random.uniform(-self.jitter, self.jitter)}
+
+    def start(self):
+        self.service.start()
+        return self
+
+    def stop(self):
+        self.service.stop()
+
+
+class FakeVumi(object):
+
+    """
+    Stand-in Vumi Go HTTP API accepting messages and metrics. Messages
+    are answered with status, which can be changed while it runs.
+    """
+
+    def __init__(self, latency=0, error_rate=0, status=200):
+        self.status = status
+        self.service = FakeService(self.respond, latency, error_rate)
+
+    @property
+    def url(self):
+        return self.service.url + "/api/v1/go/http_api_nostream"
+
+    @property
+    def messages(self):
+        return [json.loads(request[3]) for request in self.service.requests
+                if request[2].endswith("/messages.json")]
+
+    def respond(self, method, path, body):
+        if path.endswith("/metrics.json"):
+            return 200, "application/json", json.dumps(
+                {"success": True, "reason": "Metrics published"})
+        if self.status != 200:
+            return self.status, "text/plain", "Fake Vumi Go error"
+        message = json.loads(body)
+        message["message_id"] = uuid.uuid4().hex
+        return 200, "application/json", json.dumps(message)
+
+    def start(self):
+        self.service.start()
+        return self
+
+    def stop(self):
+        self.service.stop()
+
+
+class FakeAAT(object):
+
+    """
+    Stand-in AAT GetLocations API returning clinics scattered up to
+    spread degrees around the requested point
+    """
+
+    def __init__(self, clinics=5, spread=0.05, latency=0, error_rate=0):
+        self.clinics = clinics
+        self.spread = spread
+        self.service = FakeService(self.respond, latency, error_rate)
+
+    @property
+    def url(self):
+        return self.service.url + "/api/lookup/GetLocations"
+
+    def respond(self, method, path, body):
+        query = urlparse.parse_qs(urlparse.urlparse(path).query)
+        x = float(query["x"][0])
+        y = float(query["y"][0])
+        # Seeded by the request so repeat lookups see the same clinics
+        rng = random.Random(path)
+        clinics = [{"OrganisationName": "Fake Clinic %s" % i,
+                    "FullAddress": "Fake Street %s" % i,
+                    "X": x + rng.uniform(-self.spread, self.spread),
+                    "Y": y + rng.uniform(-self.spread, self.spread)}
+                   for i in range(self.clinics)]
+        return 200, "application/json", json.dumps({"clinics": clinics})
+
+    def start(self):
+        self.service.start()
+        return self
+
+    def stop(self):
+        self.service.stop()
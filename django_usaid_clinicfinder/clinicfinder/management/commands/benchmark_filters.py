@@ -0,0 +1,89 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.contrib.gis.geos import Point
+
+from clinicfinder.models import (PointOfInterest, LookupPointOfInterest,
+                                 LookupLocation)
+from clinicfinder.tasks import location_finder
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+
+    """
+    Times category filters on a synthetic clinic table. Everything is
+    created inside a transaction that is rolled back at the end.
+    """
+    help = "Benchmark hstore vs typed column point of interest filters"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clinics', type='int', default=100000,
+                    help='Number of synthetic clinics to create'),
+        make_option('--repeat', type='int', default=20,
+                    help='Number of times to run each query'),
+    )
+
+    def create_clinics(self, count):
+        cursor = connection.cursor()
+        # Random points over South Africa's bounding box
+        cursor.execute(
+            "INSERT INTO clinicfinder_location "
+            "(point, geog, created_at, updated_at) "
+            "SELECT p, p::geography, now(), now() FROM ("
+            "SELECT ST_SetSRID(ST_MakePoint("
+            "16.5 + random() * 16, -34.8 + random() * 12), 4326) AS p "
+            "FROM generate_series(1, %s)) AS points", [count])
+        cursor.execute(
+            "INSERT INTO clinicfinder_pointofinterest "
+            "(location_id, data, hct, mmc, created_at, updated_at) "
+            "SELECT id, hstore(ARRAY["
+            "'Clinic Name', 'Clinic ' || id, 'hct', hct::text, "
+            "'mmc', mmc::text]), hct, mmc, now(), now() FROM ("
+            "SELECT id, random() < 0.3 AS hct, random() < 0.1 AS mmc "
+            "FROM clinicfinder_location) AS clinics")
+        cursor.execute("ANALYZE clinicfinder_location")
+        cursor.execute("ANALYZE clinicfinder_pointofinterest")
+
+    def time_query(self, label, query, repeat):
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            query()
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        self.stdout.write("%-32s median %8.2fms  max %8.2fms" % (
+            label, timings[len(timings) // 2], timings[-1]))
+
+    def handle(self, *args, **options):
+        lookuppoi = LookupPointOfInterest(search={"mmc": "true"})
+        try:
+            with transaction.atomic():
+                self.create_clinics(options['clinics'])
+                lookuppoi.location = LookupLocation.objects.create(
+                    point=Point(28.0, -26.2))
+                self.time_query(
+                    "hstore contains (count)",
+                    PointOfInterest.objects.filter(
+                        data__contains={"mmc": "true"}).count,
+                    options['repeat'])
+                self.time_query(
+                    "typed column (count)",
+                    PointOfInterest.objects.filter(mmc=True).count,
+                    options['repeat'])
+                for typed in (False, True):
+                    with override_settings(LOCATION_TYPED_FILTERS=typed):
+                        self.time_query(
+                            "nearest search typed=%s" % typed,
+                            lambda: location_finder.search_internal(
+                                lookuppoi),
+                            options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
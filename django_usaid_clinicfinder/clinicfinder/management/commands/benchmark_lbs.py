@@ -0,0 +1,80 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+import mock
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from clinicfinder.clients import lbs_client, lbs_rate_limiter
+from clinicfinder.fakes import FakeLBS
+from clinicfinder.models import LBSRequest
+from clinicfinder.tasks import lbs_batch_lookup, metrics_buffer
+
+
+class Command(BaseCommand):
+
+    """
+    Compares one-at-a-time LBS lookups with the batch worker pool
+    against a local fake LBS SOAP service. Nothing is written to the
+    database and SOAP timing metrics are not sent.
+    """
+    help = "Benchmark single vs batched LBS lookups"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=200,
+                    help='Number of lookups to make in each mode'),
+        make_option('--latency', type='float', default=0.05,
+                    help='Seconds the fake LBS API takes per call'),
+        make_option('--workers', type='int', default=None,
+                    help='Batch pool size, defaults to LBS_BATCH_WORKERS'),
+        make_option('--rate', type='float', default=None,
+                    help='Calls a second allowed, defaults to no limit'),
+    )
+
+    def lookups(self, mode, count):
+        # Fresh MSISDNs so every lookup whitelists and locates
+        return [LBSRequest(search={"msisdn": "27%s%09d" % (mode, i)})
+                for i in range(count)]
+
+    def report(self, label, count, elapsed):
+        self.stdout.write("%-8s %5d lookups in %7.2fs  %8.1f lookups/s" % (
+            label, count, elapsed, count / elapsed))
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.LBS_BATCH_WORKERS
+        count = options['requests']
+        lbs = FakeLBS(latency=options['latency']).start()
+        try:
+            with override_settings(LBS_API_WSDL=lbs.wsdl_url,
+                                   LBS_API_RATE_LIMIT=options['rate']), \
+                    mock.patch.object(metrics_buffer, "record"):
+                lbs_client.reset()
+                lbs_client.get_client()
+
+                cache.clear()
+                lbs_rate_limiter.reset()
+                start = time.time()
+                for lbsrequest in self.lookups(1, count):
+                    lbs_batch_lookup.lookup(lbsrequest)
+                self.report("single", count, time.time() - start)
+
+                cache.clear()
+                lbs_rate_limiter.reset()
+                pool = ThreadPool(workers)
+                start = time.time()
+                try:
+                    pool.map(lbs_batch_lookup.lookup, self.lookups(2, count))
+                finally:
+                    pool.close()
+                    pool.join()
+                self.report("batch", count, time.time() - start)
+        finally:
+            lbs_client.reset()
+            lbs.stop()
+        calls = [request for request in lbs.service.requests
+                 if request[1] == "POST"]
+        self.stdout.write("%d SOAP calls served by the fake LBS API" % (
+            len(calls)))
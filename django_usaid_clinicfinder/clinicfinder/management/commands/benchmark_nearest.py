@@ -0,0 +1,98 @@
+import json
+import random
+import time
+from optparse import make_option
+
+import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from clinicfinder.management.commands.benchmark_filters import (
+    Command as FiltersBenchmark, Rollback)
+from clinicfinder.management.commands.benchmark_pipeline import summarise
+from clinicfinder.models import LookupPointOfInterest
+from clinicfinder.spatial import bump_data_version
+from clinicfinder.tasks import metrics_buffer
+from clinicfinder.views import NearestClinicView
+
+
+class Command(BaseCommand):
+
+    """
+    Load tests the nearest clinic API in this process against a
+    synthetic clinic table, first with a cold search cache and then
+    repeating the same points against a warm one. Requests go through
+    the view one after another inside a transaction that is rolled
+    back at the end, as other connections would not see the clinics.
+    The default cache is cleared and metrics are not sent.
+    """
+    help = "Benchmark nearest clinic API latency against its budget"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clinics', type='int', default=100000,
+                    help='Number of synthetic clinics to create'),
+        make_option('--requests', type='int', default=1000,
+                    help='Number of API requests in each run'),
+        make_option('--source', default=None,
+                    help='Search source, defaults to NEAREST_API_SOURCE'),
+    )
+
+    def points(self, count):
+        # Random points over South Africa's bounding box
+        return [(16.5 + random.random() * 16, -34.8 + random.random() * 12)
+                for i in range(count)]
+
+    def get(self, point):
+        params = {"lon": point[0], "lat": point[1], "mmc": "true",
+                  "source": self.source}
+        request = self.factory.get(reverse('nearest'), params)
+        force_authenticate(request, user=self.user)
+        start = time.time()
+        response = self.view(request)
+        return (time.time() - start) * 1000, response.status_code
+
+    def run_requests(self, points):
+        results = [self.get(point) for point in points]
+        report = summarise([took for took, code in results])
+        budget = settings.NEAREST_API_BUDGET_MS
+        report["over_budget"] = len(
+            [took for took, code in results if took > budget])
+        report["errors"] = len([code for took, code in results
+                                if code != 200])
+        return report
+
+    def handle(self, *args, **options):
+        self.source = options['source'] or settings.NEAREST_API_SOURCE
+        self.factory = APIRequestFactory()
+        self.view = NearestClinicView.as_view()
+        self.user = User(username="benchmark")
+        points = self.points(options['requests'])
+        report = {
+            "clinics": options['clinics'],
+            "requests": options['requests'],
+            "source": self.source,
+            "budget_ms": settings.NEAREST_API_BUDGET_MS,
+        }
+        lookups = LookupPointOfInterest.objects.count()
+        try:
+            with transaction.atomic(), \
+                    mock.patch.object(metrics_buffer, "record"):
+                FiltersBenchmark().create_clinics(options['clinics'])
+                bump_data_version()
+                cache.clear()
+                report["cold"] = self.run_requests(points)
+                report["warm"] = self.run_requests(points)
+                report["lookups_created"] = (
+                    LookupPointOfInterest.objects.count() - lookups)
+                raise Rollback()
+        except Rollback:
+            pass
+        finally:
+            bump_data_version()
+            cache.clear()
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
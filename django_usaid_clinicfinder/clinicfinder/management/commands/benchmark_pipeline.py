@@ -0,0 +1,244 @@
+import json
+import math
+import threading
+import time
+from optparse import make_option
+
+from celery.signals import task_prerun, task_postrun, task_failure
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.test.utils import override_settings
+
+from clinicfinder.clients import aat_client, lbs_client
+from clinicfinder.fakes import FakeAAT, FakeLBS, FakeVumi
+from clinicfinder.management.commands.benchmark_filters import (
+    Command as FilterBenchmark, Rollback)
+from clinicfinder.models import LBSRequest, LookupPointOfInterest
+from clinicfinder.spatial import bump_data_version
+from clinicfinder.tasks import (LBS_Batch_Lookup, lbs_batch_lookup,
+                                metrics_buffer)
+
+
+def percentile(timings, percent):
+    """
+    Nearest rank percentile of sorted timings
+    """
+    rank = int(math.ceil(percent / 100.0 * len(timings))) - 1
+    return timings[max(rank, 0)]
+
+
+def summarise(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {"count": 0}
+    return {
+        "count": len(timings),
+        "mean": round(sum(timings) / len(timings), 2),
+        "p50": round(percentile(timings, 50), 2),
+        "p95": round(percentile(timings, 95), 2),
+        "p99": round(percentile(timings, 99), 2),
+        "max": round(timings[-1], 2),
+    }
+
+
+class StageTimer(object):
+
+    """
+    Records the milliseconds and queries spent in each Celery task.
+    Tasks run eagerly inside another are only counted in their own
+    stage.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.queries = {}
+        self.failures = {}
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def started(self, sender=None, **kwargs):
+        self.stack().append([time.time(), len(connection.queries), 0, 0])
+
+    def finished(self, sender=None, **kwargs):
+        stack = self.stack()
+        started, queries, child_time, child_queries = stack.pop()
+        elapsed = time.time() - started
+        queried = len(connection.queries) - queries
+        if stack:
+            stack[-1][2] += elapsed
+            stack[-1][3] += queried
+        with self.lock:
+            self.timings.setdefault(sender.name, []).append(
+                (elapsed - child_time) * 1000)
+            self.queries[sender.name] = (
+                self.queries.get(sender.name, 0) + queried - child_queries)
+
+    def failed(self, sender=None, **kwargs):
+        with self.lock:
+            self.failures[sender.name] = self.failures.get(sender.name, 0) + 1
+
+    def connect(self):
+        task_prerun.connect(self.started, weak=False)
+        task_postrun.connect(self.finished, weak=False)
+        task_failure.connect(self.failed, weak=False)
+
+    def disconnect(self):
+        task_prerun.disconnect(self.started)
+        task_postrun.disconnect(self.finished)
+        task_failure.disconnect(self.failed)
+
+    def report(self):
+        stages = {}
+        for name, timings in self.timings.items():
+            stage = summarise(timings)
+            stage["queries"] = self.queries[name]
+            stage["queries_per_call"] = round(
+                float(self.queries[name]) / len(timings), 2)
+            stage["failures"] = self.failures.get(name, 0)
+            stages[name.rsplit(".", 1)[-1]] = stage
+        return stages
+
+
+class Command(BaseCommand):
+
+    """
+    Drives LBS requests through lbs_lookup, location_finder and
+    location_sender against local fake LBS, Vumi Go and AAT services,
+    running every task eagerly in this process. Prints a JSON report of
+    throughput and per stage timings and query counts. Everything is
+    written inside a transaction that is rolled back at the end, but the
+    default cache is cleared, so use a scratch database and cache.
+    """
+    help = "Benchmark the LBS lookup pipeline end to end"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=1000,
+                    help='Number of LBS requests to create'),
+        make_option('--clinics', type='int', default=10000,
+                    help='Synthetic clinics to add, 0 uses existing data'),
+        make_option('--mode', default='single',
+                    help="LBS_LOOKUP_MODE, 'single', 'batch' or 'pipeline'"),
+        make_option('--source', default='internal',
+                    help='Search source used by location_finder'),
+        make_option('--lbs-latency', type='float', default=0.05,
+                    help='Seconds the fake LBS API takes per call'),
+        make_option('--vumi-latency', type='float', default=0.02,
+                    help='Seconds the fake Vumi Go API takes per call'),
+        make_option('--aat-latency', type='float', default=0.1,
+                    help='Seconds the fake AAT API takes per call'),
+        make_option('--error-rate', type='float', default=0,
+                    help='Fraction of fake service calls that fail'),
+        make_option('--jitter', type='float', default=0.5,
+                    help='Degrees LBS locations spread around Gauteng'),
+        make_option('--output', default=None,
+                    help='Also write the JSON report to this file'),
+    )
+
+    def create_request(self, i):
+        lookuppoi = LookupPointOfInterest.objects.create(
+            search={"mmc": "true"},
+            response={
+                "type": "SMS",
+                "to_addr": "+27%09d" % i,
+                "template": "Your nearest clinic is: {{ results }}"
+            })
+        return LBSRequest.objects.create(
+            search={"msisdn": "27%09d" % i}, pointofinterest=lookuppoi)
+
+    def run_pipeline(self, options):
+        count = options['requests']
+        latencies = []
+        report = {}
+        try:
+            with transaction.atomic():
+                if options['clinics']:
+                    FilterBenchmark().create_clinics(options['clinics'])
+                if options['mode'] == 'batch':
+                    # Queue every request before the single batch run
+                    cache.set(LBS_Batch_Lookup.SCHEDULED_KEY, True)
+                started = time.time()
+                for i in range(count):
+                    request_started = time.time()
+                    self.create_request(i)
+                    latencies.append((time.time() - request_started) * 1000)
+                    reset_queries()
+                if options['mode'] == 'batch':
+                    lbs_batch_lookup.delay()
+                elapsed = time.time() - started
+                report["seconds"] = round(elapsed, 3)
+                report["throughput"] = round(count / elapsed, 2)
+                report["sent"] = LookupPointOfInterest.objects.filter(
+                    response__contains={"sent": "true"}).count()
+                raise Rollback()
+        except Rollback:
+            pass
+        if options['mode'] == 'single':
+            report["end_to_end_ms"] = summarise(latencies)
+        return report
+
+    def handle(self, *args, **options):
+        lbs = FakeLBS(x=28.0, y=-26.2, latency=options['lbs_latency'],
+                      error_rate=options['error_rate'],
+                      jitter=options['jitter']).start()
+        vumi = FakeVumi(latency=options['vumi_latency'],
+                        error_rate=options['error_rate']).start()
+        aat = FakeAAT(latency=options['aat_latency'],
+                      error_rate=options['error_rate']).start()
+        timer = StageTimer()
+        conf = lbs_batch_lookup.app.conf
+        always_eager = conf.CELERY_ALWAYS_EAGER
+        use_debug_cursor = connection.use_debug_cursor
+        conf.CELERY_ALWAYS_EAGER = True
+        connection.use_debug_cursor = True
+        timer.connect()
+        cache.clear()
+        lbs_client.reset()
+        aat_client.reset()
+        try:
+            with override_settings(
+                    LBS_API_WSDL=lbs.wsdl_url, VUMI_GO_API_URL=vumi.url,
+                    AAT_API_URL=aat.url, LBS_LOOKUP_MODE=options['mode'],
+                    LOCATION_DEFAULT_SOURCE=options['source'],
+                    LBS_LOCATION_REUSE_WINDOW=0,
+                    LOCATION_COALESCE_WINDOW=0):
+                report = self.run_pipeline(options)
+                # Sent while the fake Vumi Go API is still running
+                metrics_buffer.flush()
+        finally:
+            timer.disconnect()
+            conf.CELERY_ALWAYS_EAGER = always_eager
+            connection.use_debug_cursor = use_debug_cursor
+            lbs_client.reset()
+            aat_client.reset()
+            for service in (lbs, vumi, aat):
+                service.stop()
+            # Cached results may refer to the rolled back clinics
+            bump_data_version()
+
+        report.update({
+            "requests": options['requests'],
+            "mode": options['mode'],
+            "source": options['source'],
+            "error_rate": options['error_rate'],
+            "stages": timer.report(),
+            "services": {
+                "lbs": {"latency": options['lbs_latency'],
+                        "calls": len(lbs.service.requests)},
+                "vumi": {"latency": options['vumi_latency'],
+                         "calls": len(vumi.service.requests),
+                         "messages": len(vumi.messages)},
+                "aat": {"latency": options['aat_latency'],
+                        "calls": len(aat.service.requests)},
+            },
+        })
+        output = json.dumps(report, indent=2, sort_keys=True)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
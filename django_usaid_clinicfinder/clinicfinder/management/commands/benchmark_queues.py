@@ -0,0 +1,250 @@
+import itertools
+import json
+import Queue
+import random
+import threading
+import time
+from optparse import make_option
+
+import mock
+from celery.app.task import Task
+from celery.signals import task_postrun
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from clinicfinder.clients import lbs_client, vumi_client
+from clinicfinder.fakes import FakeLBS, FakeVumi
+from clinicfinder.management.commands.benchmark_pipeline import (
+    Command as PipelineBenchmark, summarise)
+from clinicfinder.models import (LBSRequest, LookupPointOfInterest,
+                                 LookupLocation, Location, PointOfInterest)
+from clinicfinder.spatial import bump_data_version
+from clinicfinder.tasks import (lbs_pipeline, location_sender,
+                                metrics_buffer, pointofinterest_importer)
+
+
+class ThreadWorkers(object):
+
+    """
+    Stand-in Celery workers running tasks on threads, a pool per
+    WORKER_PROFILES entry consuming its queues by priority. Unrouted,
+    every task shares one first in first out queue and all the threads,
+    as when everything went to the default queue.
+    """
+
+    def __init__(self, app, routed):
+        self.app = app
+        self.routed = routed
+        self.counter = itertools.count()
+        self.queues = {}
+        self.threads = []
+        self.lock = threading.Lock()
+        self.failures = 0
+
+    def start(self):
+        profiles = settings.WORKER_PROFILES.values()
+        if self.routed:
+            for profile in profiles:
+                queue = Queue.PriorityQueue()
+                for name in profile["queues"]:
+                    self.queues[name] = queue
+                self.add_threads(queue, profile["concurrency"])
+        else:
+            self.shared = Queue.PriorityQueue()
+            self.add_threads(self.shared, sum(
+                profile["concurrency"] for profile in profiles))
+        return self
+
+    def add_threads(self, queue, count):
+        for i in range(count):
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append((queue, thread))
+
+    def work(self, queue):
+        try:
+            while True:
+                priority, order, item = queue.get()
+                if item is None:
+                    return
+                task, args, kwargs = item
+                if task.apply(args, kwargs).failed():
+                    with self.lock:
+                        self.failures += 1
+        finally:
+            connection.close()
+
+    def apply_async(self, task, args=None, kwargs=None, countdown=None,
+                    **options):
+        if self.routed:
+            options = self.app.amqp.router.route(
+                options, task.name, args, kwargs)
+            queue = self.queues[options["queue"].name]
+            priority = options.get("priority") or 0
+        else:
+            queue = self.shared
+            priority = 0
+        item = (priority, next(self.counter),
+                (task, args or (), kwargs or {}))
+        if countdown:
+            timer = threading.Timer(countdown, queue.put, (item,))
+            timer.daemon = True
+            timer.start()
+        else:
+            queue.put(item)
+
+    def stop(self):
+        # Sorted after any queued work so imports finish first
+        for queue, thread in self.threads:
+            queue.put((100, next(self.counter), None))
+        for queue, thread in self.threads:
+            thread.join()
+
+
+class Command(BaseCommand):
+
+    """
+    Measures how long SMS lookups take end to end while CSV imports are
+    running, first with every task on one queue and then routed to the
+    WORKER_PROFILES queues. Tasks run on threads in this process
+    against local fake LBS and Vumi Go services and the configured
+    database, with the threads of each profile standing in for its
+    worker processes. Rows created are deleted at the end, but the
+    default cache is cleared, so use a scratch database and cache.
+    """
+    help = "Benchmark lookup latency during an import, shared vs routed"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=200,
+                    help='Number of LBS requests to make in each run'),
+        make_option('--rate', type='float', default=20,
+                    help='LBS requests created a second'),
+        make_option('--imports', type='int', default=40,
+                    help='Import tasks queued before the requests'),
+        make_option('--import-rows', type='int', default=250,
+                    help='Clinics in each import'),
+        make_option('--mode', default='single',
+                    help="LBS_LOOKUP_MODE, 'single', 'batch' or 'pipeline'"),
+        make_option('--lbs-latency', type='float', default=0.05,
+                    help='Seconds the fake LBS API takes per call'),
+        make_option('--vumi-latency', type='float', default=0.02,
+                    help='Seconds the fake Vumi Go API takes per call'),
+        make_option('--timeout', type='float', default=600,
+                    help='Seconds to wait for each run to finish'),
+    )
+
+    def import_rows(self, count):
+        return [{
+            "Clinic Name": "Benchmark import %s" % i,
+            "Benchmark": "true",
+            "MMC": "true",
+            "HCT": "true",
+            "Latitude": str(-26.2 + random.uniform(-0.5, 0.5)),
+            "Longitude": str(28.0 + random.uniform(-0.5, 0.5)),
+        } for i in range(count)]
+
+    def finished(self, sender=None, args=None, **kwargs):
+        if sender.name == location_sender.name:
+            lookup_id = args[0]
+        elif sender.name == lbs_pipeline.name:
+            lookup_id = self.lookups.get(args[0])
+        else:
+            return
+        if lookup_id is not None:
+            self.done.setdefault(lookup_id, time.time())
+
+    def run_workers(self, routed, offset, options):
+        workers = ThreadWorkers(lbs_pipeline.app, routed).start()
+        count = options['requests']
+        self.created = {}
+        self.done = {}
+        self.lookups = {}
+        with mock.patch.object(
+                Task, "apply_async",
+                lambda task, args=None, kwargs=None, **extra:
+                workers.apply_async(task, args, kwargs, **extra)):
+            for i in range(options['imports']):
+                pointofinterest_importer.delay(
+                    self.import_rows(options['import_rows']))
+            started = time.time()
+            for i in range(count):
+                # Paced so requests arrive at the given rate
+                time.sleep(max(0, started + i / options['rate'] -
+                               time.time()))
+                requested = time.time()
+                lbsrequest = PipelineBenchmark().create_request(offset + i)
+                self.created[lbsrequest.pointofinterest_id] = requested
+                self.lookups[lbsrequest.id] = lbsrequest.pointofinterest_id
+            deadline = time.time() + options['timeout']
+            while (len(set(self.done) & set(self.created)) < count and
+                   time.time() < deadline):
+                time.sleep(0.1)
+            metrics_buffer.flush()
+            workers.stop()
+        latencies = [(self.done[lookup_id] - created) * 1000
+                     for lookup_id, created in self.created.items()
+                     if lookup_id in self.done]
+        report = summarise(latencies)
+        report["unfinished"] = count - len(latencies)
+        report["task_failures"] = workers.failures
+        report["seconds"] = round(time.time() - started, 3)
+        return report
+
+    def clean_up(self):
+        lookups = LookupPointOfInterest.objects.filter(pk__in=self.created)
+        locations = list(lookups.exclude(location=None).values_list(
+            "location_id", flat=True))
+        LBSRequest.objects.filter(pointofinterest__in=lookups).delete()
+        lookups.delete()
+        LookupLocation.objects.filter(pk__in=locations).delete()
+        clinics = PointOfInterest.objects.filter(
+            data__contains={"Benchmark": "true"})
+        locations = list(clinics.values_list("location_id", flat=True))
+        clinics.delete()
+        Location.objects.filter(pk__in=locations).delete()
+        bump_data_version()
+
+    def handle(self, *args, **options):
+        lbs = FakeLBS(x=28.0, y=-26.2,
+                      latency=options['lbs_latency']).start()
+        vumi = FakeVumi(latency=options['vumi_latency']).start()
+        report = {
+            "requests": options['requests'],
+            "rate": options['rate'],
+            "imports": options['imports'],
+            "import_rows": options['import_rows'],
+            "mode": options['mode'],
+            "profiles": settings.WORKER_PROFILES,
+        }
+        self.created = {}
+        task_postrun.connect(self.finished, weak=False)
+        try:
+            with override_settings(
+                    LBS_API_WSDL=lbs.wsdl_url, VUMI_GO_API_URL=vumi.url,
+                    LBS_LOOKUP_MODE=options['mode'],
+                    LOCATION_SEND_MODE='single',
+                    LOCATION_PRECOMPUTE_ON_IMPORT=False,
+                    LBS_LOCATION_REUSE_WINDOW=0,
+                    LOCATION_COALESCE_WINDOW=0):
+                for offset, routed in enumerate((False, True)):
+                    cache.clear()
+                    lbs_client.reset()
+                    vumi_client.reset()
+                    try:
+                        report["routed" if routed else "shared"] = (
+                            self.run_workers(
+                                routed, offset * options['requests'],
+                                options))
+                    finally:
+                        self.clean_up()
+        finally:
+            task_postrun.disconnect(self.finished)
+            lbs_client.reset()
+            vumi_client.reset()
+            lbs.stop()
+            vumi.stop()
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
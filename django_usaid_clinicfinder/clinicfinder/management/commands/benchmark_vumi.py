@@ -0,0 +1,100 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+import mock
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from go_http.send import HttpApiSender
+
+from clinicfinder.clients import vumi_client
+from clinicfinder.fakes import FakeVumi
+from clinicfinder.models import LookupPointOfInterest
+from clinicfinder.tasks import (Location_Sender, location_batch_sender,
+                                metrics_buffer)
+
+
+class Command(BaseCommand):
+
+    """
+    Compares sending result messages with a new Vumi Go sender per
+    message, the pooled sender one at a time and the batch sender
+    against a local fake Vumi Go API. Nothing is written to the
+    database and metrics are not sent.
+    """
+    help = "Benchmark unpooled, pooled and batched Vumi Go sends"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', default=200,
+                    help='Number of messages to send in each mode'),
+        make_option('--latency', type='float', default=0.02,
+                    help='Seconds the fake Vumi Go API takes per call'),
+        make_option('--workers', type='int', default=None,
+                    help='Batch pool size, defaults to VUMI_GO_POOL_SIZE'),
+    )
+
+    def lookups(self, mode, count):
+        # Different addresses so no message is suppressed as a duplicate
+        return [LookupPointOfInterest(response={
+            "type": "SMS",
+            "to_addr": "+27%s%09d" % (mode, i),
+            "template": "Your nearest clinic is: {{ results }}",
+            "results": "Seapoint Clinic (Seapoint)"
+        }) for i in range(count)]
+
+    def unpooled_sender(self):
+        return HttpApiSender(
+            account_key=settings.VUMI_GO_ACCOUNT_KEY,
+            conversation_key=settings.VUMI_GO_CONVERSATION_KEY,
+            conversation_token=settings.VUMI_GO_ACCOUNT_TOKEN,
+            api_url=settings.VUMI_GO_API_URL)
+
+    def report(self, label, count, elapsed, connections):
+        self.stdout.write(
+            "%-8s %5d messages in %7.2fs  %8.1f messages/s  "
+            "%4d connections" % (
+                label, count, elapsed, count / elapsed, connections))
+
+    def run_mode(self, label, mode, count, send):
+        connections = len(self.vumi.service.server.connections)
+        cache.clear()
+        start = time.time()
+        send(self.lookups(mode, count))
+        self.report(label, count, time.time() - start,
+                    len(self.vumi.service.server.connections) - connections)
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.VUMI_GO_POOL_SIZE
+        count = options['messages']
+        self.vumi = FakeVumi(latency=options['latency']).start()
+
+        def send_each(lookups):
+            for lookuppoi in lookups:
+                location_batch_sender.send(lookuppoi)
+
+        def send_batch(lookups):
+            pool = ThreadPool(workers)
+            try:
+                pool.map(location_batch_sender.send, lookups)
+            finally:
+                pool.close()
+                pool.join()
+
+        try:
+            with override_settings(VUMI_GO_API_URL=self.vumi.url,
+                                   VUMI_GO_POOL_SIZE=workers), \
+                    mock.patch.object(metrics_buffer, "record"):
+                vumi_client.reset()
+                with mock.patch.object(
+                        Location_Sender, "vumi_client",
+                        lambda task: self.unpooled_sender()):
+                    self.run_mode("unpooled", 1, count, send_each)
+                self.run_mode("pooled", 2, count, send_each)
+                self.run_mode("batch", 3, count, send_batch)
+        finally:
+            vumi_client.reset()
+            self.vumi.stop()
+        self.stdout.write("%d messages accepted by the fake Vumi Go API" % (
+            len(self.vumi.messages)))
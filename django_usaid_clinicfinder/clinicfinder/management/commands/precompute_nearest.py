@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from clinicfinder.tasks import nearest_precomputer
+
+
+class Command(BaseCommand):
+
+    """
+    Rebuilds the whole precomputed nearest clinic table
+    """
+    help = "Precompute the nearest clinics for every grid cell"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--async', action='store_true', default=False,
+                    help='Queue the rebuild on Celery instead'),
+    )
+
+    def handle(self, *args, **options):
+        if options['async']:
+            nearest_precomputer.delay()
+            self.stdout.write("Queued nearest clinic precompute")
+        else:
+            cells = nearest_precomputer.run()
+            self.stdout.write("Precomputed %s cells" % cells)
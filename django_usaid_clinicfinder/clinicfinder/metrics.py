@@ -0,0 +1,171 @@
+import errno
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsBuffer(object):
+
+    """
+    Per-worker buffer aggregating metrics by name and aggregation. They
+    are handed to send as one list of [metric, value, agg] once
+    METRICS_FLUSH_SIZE events are recorded or METRICS_FLUSH_INTERVAL
+    seconds pass. Unsent values are kept in a small file under
+    METRICS_BUFFER_PATH so a restarted worker can send them.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self.events = 0
+        self.flushed_at = time.time()
+        self.persisted_at = 0
+        self.timer = None
+
+    @property
+    def path(self):
+        return (settings.METRICS_BUFFER_PATH or
+                os.path.join(tempfile.gettempdir(), "clinicfinder-metrics"))
+
+    def filename(self, pid=None):
+        return os.path.join(self.path, "%s-%s.json" % (
+            socket.gethostname(), pid or os.getpid()))
+
+    def add(self, metric, value, agg, count=1):
+        # Called with the lock held
+        current = self.values.get((metric, agg))
+        if current is None:
+            self.values[(metric, agg)] = [value, count]
+            return
+        if agg in ("sum", "avg"):
+            current[0] += value
+        elif agg == "max":
+            current[0] = max(current[0], value)
+        elif agg == "min":
+            current[0] = min(current[0], value)
+        else:
+            current[0] = value
+        current[1] += count
+
+    def record(self, metric, value, agg):
+        """
+        Adds a value, firing it straight away when buffering is off
+        """
+        if not settings.METRICS_BUFFER_ENABLED:
+            self.send([[metric, value, agg]])
+            return
+        with self.lock:
+            self.add(metric, float(value), agg)
+            self.events += 1
+            due = (self.events >= settings.METRICS_FLUSH_SIZE or
+                   time.time() - self.flushed_at >=
+                   settings.METRICS_FLUSH_INTERVAL)
+            if not due and self.timer is None:
+                self.timer = threading.Timer(
+                    settings.METRICS_FLUSH_INTERVAL, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if due:
+            self.flush()
+        elif time.time() - self.persisted_at >= 1:
+            self.persist()
+
+    def snapshot(self):
+        # Called with the lock held
+        return [[metric, agg, value, count]
+                for (metric, agg), (value, count) in self.values.items()]
+
+    def persist(self):
+        with self.lock:
+            snapshot = self.snapshot()
+            self.persisted_at = time.time()
+        filename = self.filename()
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.rename(filename + ".tmp", filename)
+        except (IOError, OSError):
+            logger.warning("Could not persist buffered metrics.",
+                           exc_info=True)
+
+    def recover(self):
+        """
+        Adds values left by workers on this host that have exited
+        """
+        if not os.path.isdir(self.path):
+            return
+        prefix = socket.gethostname() + "-"
+        for name in os.listdir(self.path):
+            if not name.startswith(prefix) or not name.endswith(".json"):
+                continue
+            try:
+                pid = int(name[len(prefix):-len(".json")])
+            except ValueError:
+                continue
+            if pid == os.getpid() or self.is_running(pid):
+                continue
+            claimed = self.filename() + ".%s" % pid
+            try:
+                # Renamed first so only one worker takes the values
+                os.rename(os.path.join(self.path, name), claimed)
+                with open(claimed) as f:
+                    snapshot = json.load(f)
+                os.remove(claimed)
+            except (IOError, OSError, ValueError):
+                continue
+            with self.lock:
+                for metric, agg, value, count in snapshot:
+                    self.add(metric, value, agg, count)
+
+    def is_running(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def flush(self):
+        """
+        Sends everything buffered in one batch. Values are kept when the
+        send fails.
+        """
+        with self.lock:
+            values = self.values
+            self.values = {}
+            self.events = 0
+            self.flushed_at = time.time()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        metrics = [
+            [metric, value / count if agg == "avg" else value, agg]
+            for (metric, agg), (value, count) in sorted(values.items())]
+        if not metrics:
+            return 0
+        try:
+            self.send(metrics)
+        except Exception:
+            logger.warning("Could not send buffered metrics.",
+                           exc_info=True)
+            with self.lock:
+                for (metric, agg), (value, count) in values.items():
+                    self.add(metric, value, agg, count)
+            self.persist()
+            return 0
+        if os.path.exists(self.filename()):
+            self.persist()
+        return len(metrics)
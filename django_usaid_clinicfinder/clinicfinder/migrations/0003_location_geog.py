@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinicfinder', '0002_auto_20150116_1642'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geog',
+            field=django.contrib.gis.db.models.fields.PointField(srid=4326, geography=True, null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(
+            "UPDATE clinicfinder_location SET geog = point::geography",
+            reverse_sql="UPDATE clinicfinder_location SET geog = NULL",
+        ),
+    ]
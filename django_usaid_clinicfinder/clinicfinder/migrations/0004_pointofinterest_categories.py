@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinicfinder', '0003_location_geog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pointofinterest',
+            name='hct',
+            field=models.NullBooleanField(db_index=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='pointofinterest',
+            name='mmc',
+            field=models.NullBooleanField(db_index=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(
+            "UPDATE clinicfinder_pointofinterest SET "
+            "hct = CASE data->'hct' WHEN 'true' THEN true "
+            "WHEN 'false' THEN false END, "
+            "mmc = CASE data->'mmc' WHEN 'true' THEN true "
+            "WHEN 'false' THEN false END",
+            reverse_sql="UPDATE clinicfinder_pointofinterest SET "
+                        "hct = NULL, mmc = NULL",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX clinicfinder_pointofinterest_data_gin "
+            "ON clinicfinder_pointofinterest USING gin (data)",
+            reverse_sql="DROP INDEX clinicfinder_pointofinterest_data_gin",
+        ),
+    ]
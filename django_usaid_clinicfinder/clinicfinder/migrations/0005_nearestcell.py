@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinicfinder', '0004_pointofinterest_categories'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NearestCell',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('cell', models.CharField(max_length=12)),
+                ('category', models.CharField(max_length=32, blank=True)),
+                ('pointsofinterest', models.CommaSeparatedIntegerField(max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='nearestcell',
+            unique_together=set([('cell', 'category')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinicfinder', '0005_nearestcell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lookuppointofinterest',
+            name='status',
+            field=models.CharField(default='pending', max_length=16, editable=False, db_index=True, choices=[('pending', 'Pending'), ('queued', 'Search queued'), ('searching', 'Searching'), ('searched', 'Searched'), ('sending', 'Sending'), ('done', 'Done')]),
+            preserve_default=True,
+        ),
+        # Lookups found before this have had their one chance to be
+        # sent, so results without 'sent' are done too. Backfilling them
+        # as searched would have the batch sender message people about
+        # requests made long ago.
+        migrations.RunSQL(
+            "UPDATE clinicfinder_lookuppointofinterest SET status = "
+            "CASE WHEN response ? 'results' THEN 'done' "
+            "ELSE 'pending' END",
+            reverse_sql="UPDATE clinicfinder_lookuppointofinterest "
+                        "SET status = 'pending'",
+        ),
+    ]
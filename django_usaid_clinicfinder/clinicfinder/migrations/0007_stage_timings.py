@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_hstore.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinicfinder', '0006_lookuppointofinterest_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lbsrequest',
+            name='timings',
+            field=django_hstore.fields.DictionaryField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='lookuppointofinterest',
+            name='timings',
+            field=django_hstore.fields.DictionaryField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='lbsrequest',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='lookuppointofinterest',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,19 +1,102 @@
-from django.db import models as djangomodels
+from django.db import models as djangomodels, router, transaction
+from django.db.models.query_utils import QueryWrapper
+from django.db.models.sql import UpdateQuery
 from django.contrib.gis.db import models as gismodels
 from django_hstore import hstore
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.conf import settings
+from django.utils import timezone
 
 
 class HStoreModel(djangomodels.Model):
     objects = hstore.HStoreManager()
 
+    # Columns only the tasks write, with transition() and update_hstore()
+    TASK_FIELDS = ()
+
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        """
+        Saves of rows already stored leave TASK_FIELDS alone, so a copy
+        loaded before a task moved on can not put it back
+        """
+        if (self.TASK_FIELDS and not self._state.adding and
+                kwargs.get("update_fields") is None and
+                not kwargs.get("force_insert")):
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.TASK_FIELDS]
+        return super(HStoreModel, self).save(*args, **kwargs)
+
+    @classmethod
+    def merge_hstore(cls, queryset, field, values, remove=(), **columns):
+        """
+        Makes the UPDATE update_hstore does for every row in queryset,
+        without loading them. Returns the number of rows updated.
+        """
+        merges = {field: values}
+        for name, value in list(columns.items()):
+            if isinstance(cls._meta.get_field(name),
+                          hstore.DictionaryField):
+                merges[name] = columns.pop(name)
+        if "updated_at" in cls._meta.get_all_field_names():
+            columns.setdefault("updated_at", timezone.now())
+        query = queryset.query.clone(UpdateQuery)
+        for name, value in merges.items():
+            hstore_field = cls._meta.get_field(name)
+            current = "COALESCE(\"%s\", ''::hstore)" % hstore_field.column
+            params = [hstore_field.get_prep_value(value)]
+            if name == field and remove:
+                current = "(%s - %%s::text[])" % current
+                params.insert(0, list(remove))
+            query.add_update_fields([(hstore_field, None, QueryWrapper(
+                "%s || %%s" % current, params))])
+        query.add_update_values(columns)
+        using = queryset._db or router.db_for_write(cls)
+        with transaction.atomic(using=using):
+            return query.get_compiler(using).execute_sql(None)
+
+    def update_hstore(self, field, values, remove=(), **columns):
+        """
+        Merges values into the field hstore, and sets any other columns
+        given, in one UPDATE of only those columns. Keys in remove are
+        deleted from the field first. Dicts given for other hstore
+        columns are merged too. Keys written concurrently by other
+        updates are kept. No save signals are sent. The instance is
+        updated to match.
+        """
+        if "updated_at" in self._meta.get_all_field_names():
+            columns.setdefault("updated_at", timezone.now())
+        using = self._state.db or router.db_for_write(
+            self.__class__, instance=self)
+        rows = self.merge_hstore(
+            self.__class__._default_manager.db_manager(using).filter(
+                pk=self.pk), field, values, remove, **columns)
+        columns[field] = values
+        for name, value in columns.items():
+            model_field = self._meta.get_field(name)
+            if not isinstance(model_field, hstore.DictionaryField):
+                setattr(self, name, value)
+                continue
+            if getattr(self, name) is None:
+                setattr(self, name, {})
+            if name == field:
+                for key in remove:
+                    getattr(self, name).pop(key, None)
+            getattr(self, name).update(model_field.get_prep_value(value))
+        return rows
+
 
 class Location(gismodels.Model):
     point = gismodels.PointField()
+    # Copy of point kept in sync on save so radius filters in metres can
+    # use the geography GiST index
+    geog = gismodels.PointField(
+        geography=True, blank=True, null=True, editable=False)
     created_at = djangomodels.DateTimeField(auto_now_add=True)
     updated_at = djangomodels.DateTimeField(auto_now=True)
 
@@ -35,6 +118,15 @@ class PointOfInterest(HStoreModel):
     # can pass attributes like null, blank, etc.
     data = hstore.DictionaryField()
     location = djangomodels.ForeignKey(Location, related_name='location')
+    # Typed copies of known category flags in data, filled in on save
+    hct = djangomodels.NullBooleanField(db_index=True, editable=False)
+    mmc = djangomodels.NullBooleanField(db_index=True, editable=False)
+
+    CATEGORY_FIELDS = ('hct', 'mmc')
+    BOOLEAN_VALUES = {"true": True, "false": False}
+
+    # Geo aware so searches can order by the related location's distance
+    objects = hstore.HStoreGeoManager()
 
     def __unicode__(self):
         # This will only work while the data is well structured
@@ -46,6 +138,26 @@ class PointOfInterest(HStoreModel):
             return "Point of Interest at %s, %s" % \
                 (self.location.point.x, self.location.point.y)
 
+    def set_categories(self):
+        for field in self.CATEGORY_FIELDS:
+            setattr(self, field,
+                    self.BOOLEAN_VALUES.get(self.data.get(field)))
+
+    @classmethod
+    def split_search(cls, search):
+        """
+        Splits a data search into filters on the typed category columns
+        and whatever still needs an hstore containment check
+        """
+        columns = {}
+        remaining = {}
+        for key, value in search.items():
+            if key in cls.CATEGORY_FIELDS and value in cls.BOOLEAN_VALUES:
+                columns[key] = cls.BOOLEAN_VALUES[value]
+            else:
+                remaining[key] = value
+        return columns, remaining
+
 
 class LookupLocation(gismodels.Model):
 
@@ -70,7 +182,24 @@ class LookupPointOfInterest(HStoreModel):
     """
     Extendable point of interest request model
     """
-    created_at = djangomodels.DateTimeField(auto_now_add=True)
+    # Pipeline states, only moved forward by transition()
+    PENDING = 'pending'
+    QUEUED = 'queued'
+    SEARCHING = 'searching'
+    SEARCHED = 'searched'
+    SENDING = 'sending'
+    DONE = 'done'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (QUEUED, 'Search queued'),
+        (SEARCHING, 'Searching'),
+        (SEARCHED, 'Searched'),
+        (SENDING, 'Sending'),
+        (DONE, 'Done'),
+    )
+    TASK_FIELDS = ('status', 'timings')
+
+    created_at = djangomodels.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = djangomodels.DateTimeField(auto_now=True)
     # can pass attributes like null, blank, etc.
     search = hstore.DictionaryField()
@@ -78,6 +207,23 @@ class LookupPointOfInterest(HStoreModel):
     location = djangomodels.ForeignKey(
         LookupLocation, related_name='lookup_location',
         blank=True, null=True)
+    status = djangomodels.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=PENDING,
+        db_index=True, editable=False)
+    # Epoch seconds each stage was queued, started and finished at, as
+    # "<stage>_queued" etc
+    timings = hstore.DictionaryField(blank=True, null=True, editable=False)
+
+    @classmethod
+    def transition(cls, pk, from_statuses, to_status):
+        """
+        Moves a lookup to to_status if it is in one of from_statuses,
+        without loading it. Returns False when it was not, so a task that
+        lost the race can stop.
+        """
+        return cls.objects.filter(
+            pk=pk, status__in=from_statuses).update(
+            status=to_status, updated_at=timezone.now()) == 1
 
     def __unicode__(self):
         # This will only work while the data is well structured
@@ -97,12 +243,15 @@ class LBSRequest(HStoreModel):
     """
     Inbound request for LBS lookup. Triggers LBS API call.
     """
-    created_at = djangomodels.DateTimeField(auto_now_add=True)
+    created_at = djangomodels.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = djangomodels.DateTimeField(auto_now=True)
     search = hstore.DictionaryField()
     response = hstore.DictionaryField(blank=True, null=True)
     pointofinterest = djangomodels.ForeignKey(
         LookupPointOfInterest, related_name='pointofinterest')
+    timings = hstore.DictionaryField(blank=True, null=True, editable=False)
+
+    TASK_FIELDS = ('timings',)
 
     def __unicode__(self):
         # This will only work while the data is well structured
@@ -112,21 +261,73 @@ class LBSRequest(HStoreModel):
             return "Request created at %s" % (self.created_at)
 
 
+class NearestCell(djangomodels.Model):
+
+    """
+    Precomputed nearest points of interest for a geohash cell and
+    category, nearest first
+    """
+    cell = djangomodels.CharField(max_length=12)
+    category = djangomodels.CharField(max_length=32, blank=True)
+    pointsofinterest = djangomodels.CommaSeparatedIntegerField(
+        max_length=255)
+    updated_at = djangomodels.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('cell', 'category'),)
+
+    def __unicode__(self):
+        return "%s [%s]" % (self.cell, self.category)
+
+    def pointofinterest_ids(self):
+        return [int(poi_id) for poi_id in self.pointsofinterest.split(',')]
+
+
 # Tasks import models from this file so must go here
-from .tasks import lbs_lookup, location_finder
+from .tasks import (lbs_lookup, lbs_batch_lookup, lbs_pipeline,
+                    location_finder)
+from .spatial import bump_data_version, data_version_deferred
 
 # Make sure new LBS Requests tasks are run via Celery
 
 
 @receiver(post_save, sender=LBSRequest)
 def fire_lbs_task_if_new(sender, instance, created, **kwargs):
-    if created:
-        lbs_lookup.delay(instance.id)
+    # Retries of a lookup still running share its result instead
+    if created and not lbs_lookup.coalesce(instance):
+        if settings.LBS_LOOKUP_MODE == "batch":
+            lbs_batch_lookup.enqueue(instance)
+        elif settings.LBS_LOOKUP_MODE == "pipeline":
+            lbs_pipeline.delay(instance.id)
+        else:
+            lbs_lookup.delay(instance.id)
 
 
 @receiver(post_save, sender=LookupPointOfInterest)
 def fire_location_finder_task_if_complete(sender, instance, created, **kwargs):
     # Lookup locaction in place and results not in place already
     if instance.location is not None and "results" not in instance.response:
-        # find match and prepare response
-        location_finder.delay(instance.id)
+        # find match and prepare response, once however often it is saved
+        location_finder.queue(instance)
+
+
+@receiver(pre_save, sender=Location)
+def sync_location_geography(sender, instance, **kwargs):
+    # Runs for fixtures and raw saves too, unlike Location.save
+    instance.geog = instance.point
+
+
+@receiver(pre_save, sender=PointOfInterest)
+def sync_pointofinterest_categories(sender, instance, **kwargs):
+    instance.set_categories()
+
+
+@receiver(post_save, sender=PointOfInterest)
+@receiver(post_delete, sender=PointOfInterest)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def expire_location_index(sender, instance, **kwargs):
+    # Clinic data changed so in-memory indexes need reloading, once at
+    # the end of an import
+    if not data_version_deferred():
+        bump_data_version()
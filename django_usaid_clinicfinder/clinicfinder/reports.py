@@ -0,0 +1,67 @@
+"""
+Pipeline latency percentiles worked out by Postgres from the stage
+timings tasks store on each LBSRequest and LookupPointOfInterest. The
+ordered-set aggregates need PostgreSQL 9.4 or later.
+"""
+from django.db import connection
+
+from .models import LBSRequest, LookupPointOfInterest
+
+PERCENTILES = (50, 95, 99)
+
+
+def timing(key):
+    return "(timings -> '%s')::float8" % key
+
+
+def waited(stage):
+    return "(%s - %s) * 1000" % (timing(stage + "_started"),
+                                 timing(stage + "_queued"))
+
+
+def ran(stage):
+    return "(%s - %s) * 1000" % (timing(stage + "_finished"),
+                                 timing(stage + "_started"))
+
+
+# Report name, model holding the timings, key the row must have and the
+# millisecond measures to take percentiles of
+REPORTS = (
+    ("lbs", LBSRequest, "lbs_finished",
+     (("wait_ms", waited("lbs")), ("run_ms", ran("lbs")))),
+    ("search", LookupPointOfInterest, "search_finished",
+     (("wait_ms", waited("search")), ("run_ms", ran("search")))),
+    ("send", LookupPointOfInterest, "send_finished",
+     (("wait_ms", waited("send")), ("run_ms", ran("send")))),
+    ("total", LookupPointOfInterest, "send_finished",
+     (("total_ms", "(%s - extract(epoch from created_at)) * 1000" %
+       timing("send_finished")),)),
+)
+
+
+def stage_latency(since, until):
+    """
+    Returns the count and p50/p95/p99 milliseconds of each stage for
+    requests created between since and until
+    """
+    fractions = [percent / 100.0 for percent in PERCENTILES]
+    report = {}
+    cursor = connection.cursor()
+    for name, model, key, measures in REPORTS:
+        aggregates = ", ".join(
+            "percentile_cont(%%s::float8[]) WITHIN GROUP (ORDER BY %s)" %
+            expression for label, expression in measures)
+        cursor.execute(
+            "SELECT count(*), %s FROM %s "
+            "WHERE created_at >= %%s AND created_at < %%s "
+            "AND timings ? %%s" % (aggregates, model._meta.db_table),
+            [fractions] * len(measures) + [since, until, key])
+        row = cursor.fetchone()
+        stage = {"count": row[0]}
+        for (label, expression), values in zip(measures, row[1:]):
+            stage[label] = dict(
+                ("p%s" % percent, value and round(value, 2))
+                for percent, value in zip(PERCENTILES, values or
+                                          [None] * len(PERCENTILES)))
+        report[name] = stage
+    return report
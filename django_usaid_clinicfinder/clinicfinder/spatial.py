@@ -0,0 +1,234 @@
+import math
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from clinicfinder.models import PointOfInterest
+
+# PostGIS ST_Distance_Sphere uses this radius, matching it keeps the
+# in-memory ordering identical to the SQL search
+EARTH_RADIUS_KM = 6370.986
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+DATA_VERSION_KEY = "clinicfinder.data_version"
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+IndexMatch = namedtuple("IndexMatch", ["distance", "poi_id", "data"])
+
+# Bulk changes on this thread hold back the per-row version bumps
+_deferred = threading.local()
+
+
+def distance_km(x1, y1, x2, y2):
+    """
+    Great circle distance in km between two lon/lat pairs
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (x1, y1, x2, y2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) *
+         math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def geohash(x, y, precision):
+    """
+    Encodes a lon/lat pair as a geohash string of precision characters
+    """
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        interval, value = (lon_range, x) if even else (lat_range, y)
+        mid = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            interval[0] = mid
+        else:
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision):
+    """
+    Returns the (width, height) in degrees of a geohash cell
+    """
+    bits = precision * 5
+    return 360.0 / 2 ** ((bits + 1) // 2), 180.0 / 2 ** (bits // 2)
+
+
+def geohash_cells_near(x, y, radius_km, precision):
+    """
+    Returns the geohashes of every cell whose centre is within the
+    bounding box of radius_km around x, y
+    """
+    width, height = geohash_cell_size(precision)
+    lon_span, lat_span = degree_spans(radius_km, y)
+    cells = set()
+    min_i = int(math.floor((x - lon_span + 180) / width))
+    max_i = int(math.floor((x + lon_span + 180) / width))
+    min_j = int(math.floor((y - lat_span + 90) / height))
+    max_j = int(math.floor((y + lat_span + 90) / height))
+    for i in range(min_i, max_i + 1):
+        for j in range(min_j, max_j + 1):
+            cells.add(geohash(-180 + (i + 0.5) * width,
+                              -90 + (j + 0.5) * height, precision))
+    return cells
+
+
+def geohash_centre(cell):
+    """
+    Returns the lon/lat centre of a geohash cell
+    """
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    even = True
+    for char in cell:
+        bits = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            interval = lon_range if even else lat_range
+            mid = (interval[0] + interval[1]) / 2
+            if bits >> shift & 1:
+                interval[0] = mid
+            else:
+                interval[1] = mid
+            even = not even
+    return ((lon_range[0] + lon_range[1]) / 2,
+            (lat_range[0] + lat_range[1]) / 2)
+
+
+def degree_spans(radius_km, latitude):
+    """
+    Returns the (longitude, latitude) spans in degrees that cover
+    radius_km around a point at the given latitude
+    """
+    lat_span = radius_km / KM_PER_DEGREE
+    lon_span = lat_span / max(math.cos(math.radians(latitude)), 0.01)
+    return lon_span, lat_span
+
+
+def get_data_version():
+    """
+    Returns the current version of the clinic data. Shared through the
+    cache so every worker sees changes made by any other process.
+    """
+    version = cache.get(DATA_VERSION_KEY)
+    if version is None:
+        # Start from a timestamp so a flushed cache never reuses an
+        # old version number
+        cache.add(DATA_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(DATA_VERSION_KEY)
+    return version
+
+
+def bump_data_version():
+    """
+    Marks all derived clinic data (indexes, caches) as stale
+    """
+    try:
+        return cache.incr(DATA_VERSION_KEY)
+    except ValueError:
+        return get_data_version()
+
+
+def data_version_deferred():
+    return getattr(_deferred, "depth", 0) > 0
+
+
+@contextmanager
+def defer_data_version():
+    """
+    Makes clinic saves on this thread skip bumping the data version,
+    bumping it once when the block exits instead
+    """
+    _deferred.depth = getattr(_deferred, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _deferred.depth -= 1
+        if not _deferred.depth:
+            bump_data_version()
+
+
+class LocationIndex(object):
+
+    """
+    Per-worker in-memory grid index of PointOfInterest records. Points
+    are bucketed into square cells of LOCATION_INDEX_CELL_SIZE degrees
+    and only the cells overlapping the search radius are scanned.
+    """
+
+    def __init__(self):
+        self.cells = {}
+        self.version = None
+        self.loaded_at = None
+
+    @property
+    def cell_size(self):
+        return settings.LOCATION_INDEX_CELL_SIZE
+
+    def cell_for(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        if time.time() - self.loaded_at > settings.LOCATION_INDEX_MAX_AGE:
+            return True
+        return self.version != get_data_version()
+
+    def load(self):
+        version = get_data_version()
+        cells = {}
+        pois = PointOfInterest.objects.select_related("location")
+        for poi in pois.iterator():
+            x, y = poi.location.point.x, poi.location.point.y
+            entry = (x, y, poi.location_id, poi.id, poi.data)
+            cells.setdefault(self.cell_for(x, y), []).append(entry)
+        self.cells = cells
+        self.version = version
+        self.loaded_at = time.time()
+
+    def search(self, point, radius_km, search, limit=None):
+        """
+        Returns IndexMatch tuples for points of interest within radius_km
+        of point whose data contains every key/value in search, nearest
+        first.
+        """
+        if self.is_stale():
+            self.load()
+        x, y = point.x, point.y
+        lon_span, lat_span = degree_spans(radius_km, y)
+        min_cell = self.cell_for(x - lon_span, y - lat_span)
+        max_cell = self.cell_for(x + lon_span, y + lat_span)
+        found = []
+        for cx in range(min_cell[0], max_cell[0] + 1):
+            for cy in range(min_cell[1], max_cell[1] + 1):
+                for px, py, location_id, poi_id, data in self.cells.get(
+                        (cx, cy), ()):
+                    if any(data.get(key) != value
+                           for key, value in search.items()):
+                        continue
+                    distance = distance_km(x, y, px, py)
+                    if distance <= radius_km:
+                        found.append((distance, location_id, poi_id, data))
+        found.sort(key=lambda match: match[:3])
+        if limit is not None:
+            found = found[:limit]
+        return [IndexMatch(match[0], match[2], match[3]) for match in found]
+
+location_index = LocationIndex()
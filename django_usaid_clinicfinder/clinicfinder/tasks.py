@@ -1,18 +1,36 @@
 from __future__ import absolute_import
+import calendar
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 import requests
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
-from suds.client import Client
+from celery.signals import worker_process_init, worker_process_shutdown
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import Distance
-from go_http.send import HttpApiSender
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from djcelery.models import TaskMeta, TaskSetMeta
 
 from django.conf import settings
+from django.core.cache import cache, caches
 
 from clinicfinder.models import (LBSRequest, LookupPointOfInterest,
                                  LookupLocation, PointOfInterest,
-                                 Location)
+                                 Location, NearestCell)
+from clinicfinder.clients import (aat_client, lbs_client, lbs_rate_limiter,
+                                  vumi_client)
+from clinicfinder.metrics import MetricsBuffer
+from clinicfinder.spatial import (location_index, defer_data_version,
+                                  get_data_version, geohash,
+                                  geohash_cells_near, geohash_centre,
+                                  distance_km)
 
 logger = get_task_logger(__name__)
 
@@ -32,23 +50,27 @@ class Metric_Sender(Task):
         """
 
     def vumi_client(self):
-        return HttpApiSender(
-            account_key=settings.VUMI_GO_ACCOUNT_KEY,
-            conversation_key=settings.VUMI_GO_CONVERSATION_KEY,
-            conversation_token=settings.VUMI_GO_ACCOUNT_TOKEN
-        )
+        return vumi_client.get_sender()
         # return LoggingSender('go_http.test')
 
-    def run(self, metric, value, agg, **kwargs):
+    def run(self, metric=None, value=None, agg=None, metrics=None, **kwargs):
         """
-        Returns count of imported records
+        Fires one metric, or a list of [metric, value, agg] in one call
         """
         l = self.get_logger(**kwargs)
 
-        l.info("Firing metric: %r [%s] -> %g" % (metric, agg, float(value)))
+        if metrics is None:
+            metrics = [[metric, value, agg]]
+        for name, amount, aggregation in metrics:
+            l.info("Firing metric: %r [%s] -> %g" % (
+                name, aggregation, float(amount)))
         try:
             sender = self.vumi_client()
-            result = sender.fire_metric(metric, value, agg=agg)
+            if len(metrics) == 1:
+                result = sender.fire_metric(*metrics[0])
+            else:
+                # fire_metric takes one metric but the API accepts a list
+                result = sender._api_request("metrics.json", metrics)
             l.info("Result of firing metric: %s" % (result["success"]))
             return result
 
@@ -59,6 +81,37 @@ class Metric_Sender(Task):
                 exc_info=True)
 
 metric_sender = Metric_Sender()
+metrics_buffer = MetricsBuffer(
+    lambda metrics: metric_sender.delay(metrics=metrics))
+
+
+def epoch(value):
+    """
+    Seconds since the epoch of an aware datetime
+    """
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def record_timing(name, ms):
+    metrics_buffer.record("timing.%s" % name, ms, "avg")
+    metrics_buffer.record("timing.%s.max" % name, ms, "max")
+
+
+def stage_timings(stage, queued, started, finished):
+    """
+    Returns the timings hstore values for one run of a pipeline stage,
+    recording its queue wait and run time metrics
+    """
+    timings = {
+        "%s_started" % stage: "%.3f" % started,
+        "%s_finished" % stage: "%.3f" % finished,
+    }
+    record_timing("%s.run_ms" % stage, (finished - started) * 1000)
+    if queued is not None:
+        timings["%s_queued" % stage] = "%.3f" % queued
+        record_timing("%s.wait_ms" % stage, (started - queued) * 1000)
+    return timings
+
 
 class LBS_Lookup(Task):
 
@@ -67,6 +120,10 @@ class LBS_Lookup(Task):
     """
     name = "clinicfinder.tasks.lbs_lookup"
     LBS_API_SUCCESS = "101"
+    WHITELIST_CACHED = {
+        "_code": LBS_API_SUCCESS,
+        "_message": "MSISDN already allowed"
+    }
 
     class FailedEventRequest(Exception):
 
@@ -78,14 +135,33 @@ class LBS_Lookup(Task):
         return msisdn.replace("+", "")
 
     def lbs_api_client(self):
-        return Client(settings.LBS_API_WSDL)
+        return lbs_client.get_thread_client()
+
+    def record_soap_timing(self, operation, started, setup_done, waited):
+        # Time spent getting a client, waiting on the rate limiter and
+        # making the SOAP call itself
+        finished = time.time()
+        setup_ms = (setup_done - started) * 1000
+        wait_ms = waited * 1000
+        call_ms = (finished - setup_done) * 1000 - wait_ms
+        logger.info("LBS %s client setup %.1fms, rate limit wait %.1fms, "
+                    "call %.1fms" % (operation, setup_ms, wait_ms, call_ms))
+        metrics_buffer.record("lbs.soap.setup_ms", setup_ms, "avg")
+        metrics_buffer.record("lbs.soap.rate_wait_ms", wait_ms, "avg")
+        metrics_buffer.record(
+            "lbs.soap.%s_ms" % operation.lower(), call_ms, "avg")
 
     def add_allowed_msisdn(self, msisdn):
+        started = time.time()
         client = self.lbs_api_client()
+        setup_done = time.time()
+        waited = lbs_rate_limiter.acquire()
         whitelist = client.service.AddAllowedMsisdn(
             username=settings.LBS_API_USERNAME,
             password=settings.LBS_API_PASSWORD,
             msisdn=self.normalize_msisdn(msisdn), permissionType=2)
+        self.record_soap_timing(
+            "AddAllowedMsisdn", started, setup_done, waited)
         response = {
             "_code": whitelist[0][0]["_code"],
             "_message": whitelist[0][0]["_message"]
@@ -93,11 +169,15 @@ class LBS_Lookup(Task):
         return response
 
     def get_location(self, msisdn):
+        started = time.time()
         client = self.lbs_api_client()
+        setup_done = time.time()
+        waited = lbs_rate_limiter.acquire()
         result = client.service.GetLocation(
             username=settings.LBS_API_USERNAME,
             password=settings.LBS_API_PASSWORD,
             msisdn=self.normalize_msisdn(msisdn))
+        self.record_soap_timing("GetLocation", started, setup_done, waited)
         response = {
             "_code": result[0][0]["_code"],
             "_message": result[0][0]["_message"]
@@ -107,6 +187,146 @@ class LBS_Lookup(Task):
             response["y"] = result[0][0]["y"]
         return response
 
+    def whitelist_key(self, msisdn):
+        return "clinicfinder.lbs.whitelisted.%s" % (
+            self.normalize_msisdn(msisdn))
+
+    def whitelist(self, msisdn):
+        whitelist = self.add_allowed_msisdn(msisdn)
+        if whitelist["_code"] == self.LBS_API_SUCCESS:
+            cache.set(self.whitelist_key(msisdn), True,
+                      settings.LBS_WHITELIST_TIMEOUT)
+        return whitelist
+
+    def is_permission_error(self, result):
+        return result["_code"] in settings.LBS_API_PERMISSION_ERRORS
+
+    def whitelisted_location(self, msisdn):
+        """
+        Returns the whitelist and location responses. Recently
+        whitelisted MSISDNs skip AddAllowedMsisdn unless the lookup is
+        refused, in which case they are whitelisted again and retried.
+        Location is None when whitelisting fails.
+        """
+        if cache.get(self.whitelist_key(msisdn)):
+            result = self.get_location(msisdn)
+            if not self.is_permission_error(result):
+                return self.WHITELIST_CACHED, result
+            cache.delete(self.whitelist_key(msisdn))
+        whitelist = self.whitelist(msisdn)
+        if whitelist["_code"] != self.LBS_API_SUCCESS:
+            return whitelist, None
+        return whitelist, self.get_location(msisdn)
+
+    def recent_lookup(self, lbsrequest):
+        """
+        Returns the latest successful lookup for the same MSISDN within
+        LBS_LOCATION_REUSE_WINDOW seconds, or None
+        """
+        if not settings.LBS_LOCATION_REUSE_WINDOW:
+            return None
+        normalized = self.normalize_msisdn(lbsrequest.search["msisdn"])
+        same_msisdn = Q()
+        for msisdn in (normalized, "+" + normalized):
+            same_msisdn |= Q(search__contains={"msisdn": msisdn})
+        since = timezone.now() - timedelta(
+            seconds=settings.LBS_LOCATION_REUSE_WINDOW)
+        # Reused lookups have no lookup_code so the window never extends
+        return LBSRequest.objects.filter(
+            same_msisdn, created_at__gte=since,
+            response__contains={"lookup_code": self.LBS_API_SUCCESS},
+            pointofinterest__location__isnull=False).exclude(
+            pk=lbsrequest.pk).select_related(
+            "pointofinterest__location").order_by("-created_at").first()
+
+    def coalesce_key(self, lbsrequest):
+        search = lbsrequest.pointofinterest.search
+        filters = '&'.join(
+            '%s=%s' % item for item in sorted(search.items()))
+        return "clinicfinder.lbs.inflight.%s.%s" % (
+            self.normalize_msisdn(lbsrequest.search["msisdn"]),
+            hashlib.md5(filters.encode('utf-8')).hexdigest())
+
+    def coalesce(self, lbsrequest):
+        """
+        Attaches a request to one already made for the same MSISDN and
+        search within LOCATION_COALESCE_WINDOW seconds. Returns False when
+        there is none and this request should run its own lookup.
+        """
+        if not settings.LOCATION_COALESCE_WINDOW:
+            return False
+        key = self.coalesce_key(lbsrequest)
+        claim = (lbsrequest.id, lbsrequest.pointofinterest_id)
+        if cache.add(key, claim, settings.LOCATION_COALESCE_WINDOW):
+            return False
+        leader_id, leader_poi_id = cache.get(key, claim)
+        try:
+            leader_poi = LookupPointOfInterest.objects.get(pk=leader_poi_id)
+        except LookupPointOfInterest.DoesNotExist:
+            cache.set(key, claim, settings.LOCATION_COALESCE_WINDOW)
+            return False
+        if leader_id == lbsrequest.id:
+            return False
+        lbsrequest.update_hstore(
+            "response", {"coalesced_with": str(leader_id)})
+        lbsrequest.pointofinterest.update_hstore(
+            "response", {"coalesced_with": str(leader_poi.id)})
+        metrics_buffer.record("lbs.coalesced", 1, "sum")
+        # Read again now coalesced_with is written, as a leader finishing
+        # before then shared its results without this request
+        leader_poi = LookupPointOfInterest.objects.get(pk=leader_poi.id)
+        if "results" in leader_poi.response:
+            location_finder.share_results(leader_poi)
+        return True
+
+    def link_location(self, lbsrequest, location):
+        # set the location object for POI to the location and search
+        lookup_poi = lbsrequest.pointofinterest
+        lookup_poi.update_hstore("response", {}, location=location)
+        if "results" not in lookup_poi.response:
+            location_finder.queue(lookup_poi)
+
+    def reuse_lookup(self, lbsrequest, previous):
+        """
+        Takes the location of an earlier lookup instead of calling the
+        LBS API. Returns the message and that location.
+        """
+        logger.info("Reusing location from LBS request <%s>" % previous.id)
+        saved_calls = 1 if cache.get(self.whitelist_key(
+            lbsrequest.search["msisdn"])) else 2
+        lbsrequest.response["reused_from"] = str(previous.id)
+        lbsrequest.response["x"] = previous.response["x"]
+        lbsrequest.response["y"] = previous.response["y"]
+        metrics_buffer.record("lbs.location.reused", 1, "sum")
+        metrics_buffer.record("lbs.soap.saved", saved_calls, "sum")
+        return "Reused recent location", previous.pointofinterest.location
+
+    def record_result(self, lbsrequest, whitelist, result):
+        """
+        Stores the LBS API responses on lbsrequest. Returns the message
+        and, when a location was found, an unsaved LookupLocation.
+        """
+        location = None
+        if whitelist["_code"] != self.LBS_API_SUCCESS:
+            logger.info("Failed to Add MSISDN to allowed list")
+            lbsrequest.response["whitelist_code"] = whitelist["_code"]
+            lbsrequest.response["whitelist_message"] = whitelist["_message"]
+            lbsrequest.response["success"] = "false"
+            return whitelist["_message"], location
+        lbsrequest.response["lookup_code"] = result["_code"]
+        lbsrequest.response["lookup_message"] = result["_message"]
+        if result["_code"] != self.LBS_API_SUCCESS:
+            logger.info("Failed to return location")
+            lbsrequest.response["success"] = "false"
+        else:
+            logger.info("Location found, creating lookup")
+            lbsrequest.response["x"] = result["x"]
+            lbsrequest.response["y"] = result["y"]
+            # Create location point
+            location = LookupLocation()
+            location.point = Point(float(result["x"]), float(result["y"]))
+        return result["_message"], location
+
     def run(self, lbsrequest_id, **kwargs):
         """
         Gets user details, adds to whitelist and gets current location
@@ -114,53 +334,196 @@ class LBS_Lookup(Task):
         l = self.get_logger(**kwargs)
 
         l.info("Processing new LBS lookup")
+        started = time.time()
         response = "No response"
         lbsrequest = LBSRequest.objects.get(pk=lbsrequest_id)
         lbsrequest.response = {}
         try:
-            whitelist = self.add_allowed_msisdn(lbsrequest.search["msisdn"])
-            if whitelist["_code"] != self.LBS_API_SUCCESS:
-                response = whitelist["_message"]
-                l.info("Failed to Add MSISDN to allowed list")
-                lbsrequest.response["whitelist_code"] = whitelist["_code"]
-                lbsrequest.response[
-                    "whitelist_message"] = whitelist["_message"]
-                lbsrequest.response["success"] = "false"
-            else:
-                # Do a lookup now we have whitelisted
-                result = self.get_location(lbsrequest.search["msisdn"])
-                lbsrequest.response["lookup_code"] = result["_code"]
-                lbsrequest.response["lookup_message"] = result["_message"]
-                if result["_code"] != self.LBS_API_SUCCESS:
-                    l.info("Failed to return location")
-                    lbsrequest.response["success"] = "false"
-                else:
-                    l.info("Location found, creating lookup")
-                    lbsrequest.response["x"] = result["x"]
-                    lbsrequest.response["y"] = result["y"]
-                    # Create location point
-                    location = LookupLocation()
-                    location.point = Point(
-                        float(result["x"]), float(result["y"]))
-                    location.save()
-                    # set the location object for POI to the location
-                    lookup_poi = lbsrequest.pointofinterest
-                    lookup_poi.location = location
-                    lookup_poi.save()
-                    l.info("Location and Point of Interest linked")
-                response = result["_message"]
+            previous = self.recent_lookup(lbsrequest)
+            if previous is not None:
+                response, location = self.reuse_lookup(lbsrequest, previous)
+                self.link_location(lbsrequest, location)
+                return response
+            whitelist, result = self.whitelisted_location(
+                lbsrequest.search["msisdn"])
+            response, location = self.record_result(
+                lbsrequest, whitelist, result)
+            if location is not None:
+                location.save()
+                self.link_location(lbsrequest, location)
+                l.info("Location and Point of Interest linked")
         except SoftTimeLimitExceeded:
             logger.error(
                 'Soft time limit exceed processing LBS lookup through \
                 SOAP API via Celery.',
                 exc_info=True)
         finally:
-            lbsrequest.save()
+            lbsrequest.update_hstore(
+                "response", lbsrequest.response, timings=stage_timings(
+                    "lbs", epoch(lbsrequest.created_at), started,
+                    time.time()))
             return response
 
 lbs_lookup = LBS_Lookup()
 
 
+class LBS_Batch_Lookup(Task):
+
+    """
+    Task to run queued LBS lookups in groups of LBS_BATCH_SIZE, making
+    the SOAP calls on LBS_BATCH_WORKERS threads
+    """
+    name = "clinicfinder.tasks.lbs_batch_lookup"
+    SCHEDULED_KEY = "clinicfinder.lbs.batch.scheduled"
+    # Cleared from the response once a request has been processed
+    CLAIM_KEYS = ("queued", "claimed_at")
+
+    def enqueue(self, lbsrequest):
+        """
+        Queues lbsrequest for the next batch, scheduling one if none is
+        due to run
+        """
+        lbsrequest.update_hstore("response", {"queued": "batch"})
+        if cache.add(self.SCHEDULED_KEY, True, settings.LBS_BATCH_DELAY):
+            self.apply_async(countdown=settings.LBS_BATCH_DELAY)
+
+    def claim(self):
+        # Locked so concurrent batches never claim the same requests.
+        # Claims older than LBS_BATCH_CLAIM_TIMEOUT were left by a batch
+        # that died and are taken again.
+        expired = time.time() - settings.LBS_BATCH_CLAIM_TIMEOUT
+        with transaction.atomic():
+            ids = list(LBSRequest.objects.select_for_update().extra(
+                where=["response -> 'queued' = 'batch' OR "
+                       "(response -> 'queued' = 'claimed' AND "
+                       "(response -> 'claimed_at')::float8 < %s)"],
+                params=[expired]).order_by(
+                "id").values_list("id", flat=True)[:settings.LBS_BATCH_SIZE])
+            LBSRequest.merge_hstore(
+                LBSRequest.objects.filter(pk__in=ids), "response",
+                {"queued": "claimed", "claimed_at": "%.3f" % time.time()})
+        return list(LBSRequest.objects.filter(pk__in=ids).select_related(
+            "pointofinterest").order_by("id"))
+
+    def lookup(self, lbsrequest):
+        # None when a SOAP call raised, which records no codes for the
+        # request just as LBS_Lookup.run does
+        try:
+            return lbs_lookup.whitelisted_location(
+                lbsrequest.search["msisdn"])
+        except Exception:
+            logger.error("LBS lookup for request <%s> failed" %
+                         lbsrequest.id, exc_info=True)
+            return None
+
+    def process(self, batch):
+        """
+        Looks up a claimed batch and writes the results back in one
+        transaction. Returns the number of SOAP lookups made.
+        """
+        started = time.time()
+        pending = []
+        for lbsrequest in batch:
+            lbsrequest.response = {}
+            previous = lbs_lookup.recent_lookup(lbsrequest)
+            if previous is not None:
+                message, location = lbs_lookup.reuse_lookup(
+                    lbsrequest, previous)
+                lbs_lookup.link_location(lbsrequest, location)
+                lbsrequest.update_hstore(
+                    "response", lbsrequest.response, remove=self.CLAIM_KEYS,
+                    timings=stage_timings(
+                        "lbs", epoch(lbsrequest.created_at), started,
+                        time.time()))
+            else:
+                pending.append(lbsrequest)
+        if not pending:
+            return 0
+
+        pool = ThreadPool(min(settings.LBS_BATCH_WORKERS, len(pending)))
+        try:
+            results = pool.map(self.lookup, pending)
+        finally:
+            pool.close()
+            pool.join()
+
+        located = []
+        finished = time.time()
+        with transaction.atomic():
+            for lbsrequest, responses in zip(pending, results):
+                location = None
+                if responses is not None:
+                    message, location = lbs_lookup.record_result(
+                        lbsrequest, *responses)
+                if location is not None:
+                    location.save()
+                    # Searches start after the commit
+                    lbsrequest.pointofinterest.update_hstore(
+                        "response", {}, location=location)
+                    located.append(lbsrequest.pointofinterest)
+                lbsrequest.update_hstore(
+                    "response", lbsrequest.response, remove=self.CLAIM_KEYS,
+                    timings=stage_timings(
+                        "lbs", epoch(lbsrequest.created_at), started,
+                        finished))
+        for lookuppoi in located:
+            location_finder.queue(lookuppoi)
+        return len(pending)
+
+    def run(self, **kwargs):
+        """
+        Processes queued LBS requests until none are left
+        """
+        l = self.get_logger(**kwargs)
+
+        l.info("Processing LBS lookup batches")
+        cache.delete(self.SCHEDULED_KEY)
+        total = 0
+        try:
+            batch = self.claim()
+            while batch:
+                started = time.time()
+                looked_up = self.process(batch)
+                elapsed = time.time() - started
+                l.info("Processed batch of %s in %.2fs" % (
+                    len(batch), elapsed))
+                metrics_buffer.record("lbs.batch.size", len(batch), "avg")
+                if looked_up:
+                    metrics_buffer.record("lbs.batch.lookups_per_second",
+                                          looked_up / elapsed, "avg")
+                total += len(batch)
+                batch = self.claim()
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing LBS lookup batch \
+                via Celery.',
+                exc_info=True)
+        return total
+
+lbs_batch_lookup = LBS_Batch_Lookup()
+
+
+@worker_process_init.connect
+def recover_metrics(**kwargs):
+    # Buffered metrics left by workers that exited before flushing
+    metrics_buffer.recover()
+
+
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    metrics_buffer.flush()
+
+
+@worker_process_init.connect
+def load_lbs_client(**kwargs):
+    # Fetch and parse the WSDL before the first SMS arrives
+    try:
+        lbs_client.get_client()
+    except Exception:
+        logger.warning('Could not preload the LBS SOAP client.',
+                       exc_info=True)
+
+
 class Location_Sender(Task):
 
     """
@@ -176,68 +539,261 @@ class Location_Sender(Task):
         """
 
     def vumi_client(self):
-        return HttpApiSender(
-            account_key=settings.VUMI_GO_ACCOUNT_KEY,
-            conversation_key=settings.VUMI_GO_CONVERSATION_KEY,
-            conversation_token=settings.VUMI_GO_ACCOUNT_TOKEN
-        )
+        return vumi_client.get_sender()
+
+    def sent_key(self, response):
+        return "clinicfinder.sms.sent.%s.%s" % (
+            response["to_addr"], hashlib.md5(
+                response["results"].encode('utf-8')).hexdigest())
 
-    def run(self, lookuppointofinterest_id, **kwargs):
+    def is_duplicate(self, response):
+        """
+        True when the same results went to the same address within
+        LOCATION_COALESCE_WINDOW seconds
+        """
+        if not settings.LOCATION_COALESCE_WINDOW:
+            return False
+        return not cache.add(self.sent_key(response), True,
+                             settings.LOCATION_COALESCE_WINDOW)
+
+    def forget_sent(self, response):
+        # The message was not sent after all, so a retry must not be
+        # suppressed
+        if settings.LOCATION_COALESCE_WINDOW:
+            cache.delete(self.sent_key(response))
+
+    def deliver(self, lookuppoi):
+        """
+        Sends the results of an SMS lookup not sent yet and marks its
+        response. Returns the Vumi response, False when no message could
+        be sent and None when none was due. The caller saves lookuppoi.
+        """
+        response = lookuppoi.response
+        if response["type"] != "SMS" or "sent" in response:
+            logger.info("No message sent for lookuppointofinterest <%s>" %
+                        str(lookuppoi.id))
+            return None
+        if self.is_duplicate(response):
+            logger.info("Duplicate message to <%s> suppressed" %
+                        response["to_addr"])
+            lookuppoi.response["sent"] = "suppressed"
+            metrics_buffer.record("sms.suppressed", 1, "sum")
+            return False
+        try:
+            return self.send_results(lookuppoi)
+        except Exception:
+            self.forget_sent(response)
+            raise
+
+    def send_results(self, lookuppoi):
+        # send via Vumi
+        response = lookuppoi.response
+        sender = self.vumi_client()
+        if response["results"] != "":
+            content = response["template"].replace(
+                "{{ results }}", response["results"])
+            vumiresponse = False
+            if len(content) <= settings.LOCATION_RESPONSE_MAX_LENGTH:
+                # Defaults to 320
+                vumiresponse = sender.send_text(response["to_addr"], content)
+                lookuppoi.response["sent"] = "true"
+                logger.info("Sent message to <%s>" % response["to_addr"])
+                metrics_buffer.record("sms.results", 1, "sum")
+            else:
+                logger.info(
+                    "Message not sent to <%s>. "
+                    "Too long at <%s> chars." %
+                    (response["to_addr"], str(len(content))))
+        else:
+            vumiresponse = sender.send_text(
+                response["to_addr"], settings.LOCATION_NONE_FOUND)
+            lookuppoi.response["sent"] = "true"
+            logger.info("Sent no results message to <%s>" %
+                        response["to_addr"])
+            metrics_buffer.record("sms.noresults", 1, "sum")
+        return vumiresponse
+
+    def finish(self, lookuppoi, queued, started):
+        """
+        Records the outcome of sending with the stage timings
+        """
+        finished = time.time()
+        outcome = {}
+        if "sent" in lookuppoi.response:
+            outcome["sent"] = lookuppoi.response["sent"]
+        record_timing("total_ms",
+                      (finished - epoch(lookuppoi.created_at)) * 1000)
+        lookuppoi.update_hstore(
+            "response", outcome, status=LookupPointOfInterest.DONE,
+            timings=stage_timings("send", queued, started, finished))
+
+    def run(self, lookuppointofinterest_id, queued_at=None, **kwargs):
         """
         Returns a filtered list of locations for query
         """
         l = self.get_logger(**kwargs)
 
         l.info("Processing new location result sending")
+        started = time.time()
+        if not LookupPointOfInterest.transition(
+                lookuppointofinterest_id,
+                (LookupPointOfInterest.PENDING,
+                 LookupPointOfInterest.SEARCHED),
+                LookupPointOfInterest.SENDING):
+            l.info("Results for lookuppointofinterest <%s> already sent" %
+                   str(lookuppointofinterest_id))
+            return None
+        sent = False
+        previous = LookupPointOfInterest.SEARCHED
         try:
             lookuppoi = LookupPointOfInterest.objects.get(
                 pk=lookuppointofinterest_id)
-            response = lookuppoi.response
-            if response["type"] == "SMS" and "sent" not in response:
-                # send via Vumi
-                sender = self.vumi_client()
-                if response["results"] != "":
-                    content = response["template"].replace(
-                        "{{ results }}", response["results"])
-                    vumiresponse = False
-                    if len(content) <= settings.LOCATION_RESPONSE_MAX_LENGTH:
-                        # Defaults to 320
-                        vumiresponse = sender.send_text(
-                            response["to_addr"], content)
-                        lookuppoi.response["sent"] = "true"
-                        l.info("Sent message to <%s>" % response["to_addr"])
-                        metric_sender.delay(
-                            metric="sms.results",
-                            value=1, agg="sum")
-                    else:
-                        l.info(
-                            "Message not sent to <%s>. "
-                            "Too long at <%s> chars." %
-                            (response["to_addr"], str(len(content))))
-                else:
-                    vumiresponse = sender.send_text(
-                        response["to_addr"], settings.LOCATION_NONE_FOUND)
-                    lookuppoi.response["sent"] = "true"
-                    l.info("Sent no results message to <%s>" %
-                           response["to_addr"])
-                    metric_sender.delay(
-                            metric="sms.noresults",
-                            value=1, agg="sum")
-                lookuppoi.save()
-
-                return vumiresponse
-            else:
-                l.info("No message sent for lookuppointofinterest <%s>" %
-                       str(lookuppointofinterest_id))
+            if "results" not in lookuppoi.response:
+                previous = LookupPointOfInterest.PENDING
+            vumiresponse = self.deliver(lookuppoi)
+            self.finish(lookuppoi, queued_at, started)
+            sent = True
+            return vumiresponse
         except SoftTimeLimitExceeded:
             logger.error(
                 'Soft time limit exceed processing location search \
                  via Celery.',
                 exc_info=True)
+        finally:
+            if not sent:
+                # Whatever went wrong, leave it to be sent again
+                LookupPointOfInterest.transition(
+                    lookuppointofinterest_id,
+                    (LookupPointOfInterest.SENDING,), previous)
 
 location_sender = Location_Sender()
 
 
+class Location_Batch_Sender(Task):
+
+    """
+    Task to send the results of searched lookups in groups of
+    LOCATION_SEND_BATCH_SIZE over VUMI_GO_POOL_SIZE pooled connections
+    """
+    name = "clinicfinder.tasks.location_batch_sender"
+    SCHEDULED_KEY = "clinicfinder.sms.batch.scheduled"
+
+    def enqueue(self, countdown=None):
+        """
+        Schedules a batch in countdown seconds, LOCATION_SEND_BATCH_DELAY
+        by default, unless one is due to run. Searched lookups are
+        picked up by their status.
+        """
+        if countdown is None:
+            countdown = settings.LOCATION_SEND_BATCH_DELAY
+        if cache.add(self.SCHEDULED_KEY, True, countdown):
+            self.apply_async(countdown=countdown)
+
+    def claim(self):
+        # Locked so concurrent batches never claim the same lookups
+        with transaction.atomic():
+            ids = list(LookupPointOfInterest.objects.select_for_update(
+            ).filter(status=LookupPointOfInterest.SEARCHED).order_by(
+                "id").values_list("id", flat=True)[
+                :settings.LOCATION_SEND_BATCH_SIZE])
+            LookupPointOfInterest.objects.filter(pk__in=ids).update(
+                status=LookupPointOfInterest.SENDING)
+        return list(LookupPointOfInterest.objects.filter(
+            pk__in=ids).order_by("id"))
+
+    def unavailable(self, error):
+        # Vumi Go could not be reached or kept answering with a server
+        # error once retries were used up
+        if isinstance(error, requests.HTTPError):
+            return (error.response is not None and
+                    error.response.status_code >= 500)
+        return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                                  requests.exceptions.RetryError))
+
+    def send(self, lookuppoi):
+        """
+        Delivers one lookup's results. Returns the time sending started,
+        or None when Vumi Go was unavailable so the lookup is sent again
+        later.
+        """
+        started = time.time()
+        try:
+            location_sender.deliver(lookuppoi)
+        except Exception as e:
+            if self.unavailable(e):
+                logger.warning("Could not reach Vumi Go for <%s>" %
+                               str(lookuppoi.id), exc_info=True)
+                return None
+            logger.error("Sending results of <%s> failed" %
+                         str(lookuppoi.id), exc_info=True)
+            lookuppoi.response["sent"] = "failed"
+        return started
+
+    def process(self, batch):
+        """
+        Sends a claimed batch and records the outcomes in one
+        transaction. Returns the lookups to send again.
+        """
+        pool = ThreadPool(min(settings.VUMI_GO_POOL_SIZE, len(batch)))
+        try:
+            sent = pool.map(self.send, batch)
+        finally:
+            pool.close()
+            pool.join()
+        unsent = []
+        with transaction.atomic():
+            for lookuppoi, started in zip(batch, sent):
+                if started is None:
+                    unsent.append(lookuppoi.id)
+                    continue
+                # Queued for sending when its search finished
+                queued = (lookuppoi.timings or {}).get("search_finished")
+                location_sender.finish(
+                    lookuppoi, queued and float(queued), started)
+        return unsent
+
+    def run(self, **kwargs):
+        """
+        Sends the results of searched lookups until none are left
+        """
+        l = self.get_logger(**kwargs)
+
+        l.info("Processing location result batches")
+        cache.delete(self.SCHEDULED_KEY)
+        total = 0
+        unsent = []
+        try:
+            batch = self.claim()
+            while batch:
+                started = time.time()
+                unsent.extend(self.process(batch))
+                elapsed = time.time() - started
+                l.info("Sent batch of %s in %.2fs" % (len(batch), elapsed))
+                metrics_buffer.record("sms.batch.size", len(batch), "avg")
+                metrics_buffer.record("sms.batch.sent_per_second",
+                                      len(batch) / elapsed, "avg")
+                total += len(batch)
+                batch = self.claim()
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing location result batch \
+                via Celery.',
+                exc_info=True)
+        finally:
+            # Released once the run is over and retried by a batch
+            # LOCATION_SEND_RETRY_DELAY later rather than straight away
+            LookupPointOfInterest.objects.filter(
+                pk__in=unsent, status=LookupPointOfInterest.SENDING).update(
+                status=LookupPointOfInterest.SEARCHED)
+            if unsent:
+                self.enqueue(settings.LOCATION_SEND_RETRY_DELAY)
+        if unsent:
+            metrics_buffer.record("sms.batch.unsent", len(unsent), "sum")
+        return total - len(unsent)
+
+location_batch_sender = Location_Batch_Sender()
+
+
 class Location_Finder(Task):
 
     """
@@ -252,60 +808,308 @@ class Location_Finder(Task):
         code.
         """
 
-    def run(self, lookuppointofinterest_id, **kwargs):
+    class DegradedMatches(list):
+
+        """
+        Search results returned while AAT was failing or slow, which
+        cached_search does not keep so the next lookup tries AAT again.
+        """
+
+    def run(self, lookuppointofinterest_id, queued_at=None, **kwargs):
         """
         Returns a filtered list of locations for query
         """
         l = self.get_logger(**kwargs)
 
         l.info("Processing new location search")
+        started = time.time()
+        if not LookupPointOfInterest.transition(
+                lookuppointofinterest_id,
+                (LookupPointOfInterest.PENDING,
+                 LookupPointOfInterest.QUEUED),
+                LookupPointOfInterest.SEARCHING):
+            l.info("Lookuppointofinterest <%s> already searched" %
+                   str(lookuppointofinterest_id))
+            return False
+        searched = False
         try:
             lookuppoi = LookupPointOfInterest.objects.get(
                 pk=lookuppointofinterest_id)
 
-            search_method_name = lookuppoi.search.get('source', 'internal')
-            search_method = {
-                'aat': self.search_aat,
-                'internal': self.search_internal,
-            }.get(search_method_name, self.search_internal)
-            matches = search_method(lookuppoi)
-
-            matches = matches[:settings.LOCATION_MAX_RESPONSES]
+            matches = self.find(lookuppoi)
             total = len(matches)
 
             output = ' AND '.join(matches)
 
-            lookuppoi.response["results"] = output
-            lookuppoi.save()
+            lookuppoi.update_hstore(
+                "response", {"results": output},
+                status=LookupPointOfInterest.SEARCHED,
+                timings=stage_timings(
+                    "search", queued_at, started, time.time()))
+            searched = True
             l.info("Completed location search. Found: %s" % str(total))
-            location_sender.delay(lookuppointofinterest_id)
+            self.share_results(lookuppoi)
+            self.queue_send(lookuppointofinterest_id)
             return True
         except SoftTimeLimitExceeded:
             logger.error(
                 'Soft time limit exceed processing location search \
                  via Celery.',
                 exc_info=True)
+        finally:
+            if not searched:
+                # Whatever went wrong, let a later save queue the search
+                # again
+                LookupPointOfInterest.transition(
+                    lookuppointofinterest_id,
+                    (LookupPointOfInterest.SEARCHING,),
+                    LookupPointOfInterest.PENDING)
+
+    def queue(self, lookuppoi):
+        """
+        Queues a search for lookuppoi unless one has been already
+        """
+        if LookupPointOfInterest.transition(
+                lookuppoi.id, (LookupPointOfInterest.PENDING,),
+                LookupPointOfInterest.QUEUED):
+            lookuppoi.status = LookupPointOfInterest.QUEUED
+            self.delay(lookuppoi.id, queued_at=time.time())
+            return True
+        return False
+
+    def queue_send(self, lookuppointofinterest_id):
+        """
+        Hands a searched lookup on to be sent
+        """
+        if settings.LOCATION_SEND_MODE == "batch":
+            location_batch_sender.enqueue()
+        else:
+            location_sender.delay(lookuppointofinterest_id,
+                                  queued_at=time.time())
+
+    def find(self, lookuppoi):
+        """
+        Returns up to LOCATION_MAX_RESPONSES formatted matches from the
+        lookup's search source
+        """
+        search_method_name = lookuppoi.search.get(
+            'source', settings.LOCATION_DEFAULT_SOURCE)
+        search_method = {
+            'aat': self.search_aat,
+            'internal': self.search_internal,
+            'index': self.search_index,
+            'knn': self.search_knn,
+            'precomputed': self.search_precomputed,
+            'hybrid': self.search_hybrid,
+        }.get(search_method_name, self.search_internal)
+        matches = self.cached_search(
+            search_method_name, search_method, lookuppoi)
+        return matches[:settings.LOCATION_MAX_RESPONSES]
+
+    def find_nearest(self, x, y, search):
+        """
+        Returns formatted matches near a point as find does for a
+        lookup, without storing anything. Database queries are cancelled
+        once they take NEAREST_API_BUDGET_MS.
+        """
+        started = time.time()
+        lookuppoi = LookupPointOfInterest(
+            search=search, location=LookupLocation(point=Point(x, y)))
+        # Inside a caller's transaction SET LOCAL would last until that
+        # ends, so its timeout is put back once the search succeeds. A
+        # failed search rolls back to the savepoint, which undoes it.
+        restore = connection.in_atomic_block
+        with transaction.atomic():
+            cursor = connection.cursor()
+            if restore:
+                cursor.execute("SHOW statement_timeout")
+                previous = cursor.fetchone()[0]
+            cursor.execute("SET LOCAL statement_timeout = %s",
+                           [int(settings.NEAREST_API_BUDGET_MS)])
+            matches = self.find(lookuppoi)
+            if restore:
+                cursor.execute("SET LOCAL statement_timeout = %s",
+                               [previous])
+        record_timing("nearest.run_ms", (time.time() - started) * 1000)
+        return matches
+
+    def share_results(self, lookuppoi):
+        """
+        Copies results to lookups coalesced with this one. They are
+        marked sent so Location_Sender never messages them again.
+        """
+        followers = LookupPointOfInterest.objects.filter(
+            response__contains={"coalesced_with": str(lookuppoi.id)})
+        for follower in followers:
+            if "results" in follower.response:
+                continue
+            follower.update_hstore("response", {
+                "results": lookuppoi.response["results"],
+                "sent": "coalesced"}, location=lookuppoi.location,
+                status=LookupPointOfInterest.DONE)
+
+    def cache_key(self, source, lookuppoi):
+        search = lookuppoi.search.copy()
+        search.pop('source', None)
+        filters = '&'.join(
+            '%s=%s' % item for item in sorted(search.items()))
+        point = lookuppoi.location.point
+        # Versioned by the clinic data so imports and edits invalidate
+        return "clinicfinder.results.%s.%s.%s.%s" % (
+            get_data_version(), source,
+            geohash(point.x, point.y, settings.LOCATION_CACHE_PRECISION),
+            hashlib.md5(filters.encode('utf-8')).hexdigest())
+
+    def cached_search(self, source, search_method, lookuppoi):
+        """
+        Returns search_method results, shared between lookups that fall
+        in the same geohash cell with the same filters
+        """
+        if not settings.LOCATION_CACHE_ENABLED:
+            return search_method(lookuppoi)
+        key = self.cache_key(source, lookuppoi)
+        matches = cache.get(key)
+        if matches is None:
+            metrics_buffer.record("search.cache.miss", 1, "sum")
+            matches = search_method(lookuppoi)
+            if isinstance(matches, self.DegradedMatches):
+                metrics_buffer.record("search.cache.degraded", 1, "sum")
+            else:
+                cache.set(key, matches, settings.LOCATION_CACHE_TIMEOUT)
+        else:
+            metrics_buffer.record("search.cache.hit", 1, "sum")
+        return matches
 
     def format_match_aat(self, match):
         return "%s (%s)" % (
             match.get('OrganisationName'),
             match.get('FullAddress'))
 
-    def search_aat(self, lookuppoi):
-        url = (
+    def aat_url(self, category, x, y):
+        return (
             "%(url)s?username=%(username)s&password=%(password)s&meters=50000"
             "&category=%(category)s&x=%(x)s&y=%(y)s") % {
                 'url': settings.AAT_API_URL,
                 'username': settings.AAT_USERNAME,
                 'password': settings.AAT_PASSWORD,
-                'category': self.get_aat_category_id(lookuppoi.search),
-                'x': lookuppoi.location.point.x,
-                'y': lookuppoi.location.point.y
+                'category': category,
+                'x': x,
+                'y': y
         }
-        response = requests.get(url, verify=False)
-        matches = response.json().get('clinics')
+
+    def fetch_aat(self, category, x, y):
+        return aat_client.get_json(self.aat_url(category, x, y)).get(
+            'clinics')
+
+    def aat_cache_key(self, category, point):
+        grid = settings.AAT_CACHE_GRID
+        return "clinicfinder.aat.%s.%d.%d" % (
+            category, math.floor(point.x / grid), math.floor(point.y / grid))
+
+    def cached_aat(self, category, point):
+        """
+        Returns AAT clinics for the grid cell point is in, refreshing
+        stale entries in the background
+        """
+        if not settings.AAT_CACHE_ENABLED:
+            return self.fetch_aat(category, point.x, point.y)
+        aat_cache = caches[settings.AAT_CACHE_ALIAS]
+        key = self.aat_cache_key(category, point)
+        cached = aat_cache.get(key)
+        if cached is None:
+            clinics = self.fetch_aat(category, point.x, point.y)
+            aat_cache.set(key, {'fetched_at': time.time(),
+                                'clinics': clinics},
+                          settings.AAT_CACHE_TIMEOUT)
+            return clinics
+        if time.time() - cached['fetched_at'] > settings.AAT_CACHE_FRESH:
+            # Serve the stale copy while a single task refreshes it
+            if aat_cache.add(key + '.refreshing', True,
+                             settings.AAT_CACHE_REFRESH_LOCK):
+                aat_cache_refresher.delay(category, point.x, point.y)
+        return cached['clinics']
+
+    def aat_distance(self, point, match):
+        if match.get('X') is None or match.get('Y') is None:
+            if match.get('DistanceMeters') is not None:
+                return float(match['DistanceMeters']) / 1000
+            return float('inf')
+        return distance_km(point.x, point.y,
+                           float(match['X']), float(match['Y']))
+
+    def search_aat(self, lookuppoi):
+        category = self.get_aat_category_id(lookuppoi.search)
+        point = lookuppoi.location.point
+        try:
+            matches = self.cached_aat(category, point)
+        except (aat_client.Unavailable, requests.RequestException,
+                ValueError):
+            logger.warning(
+                'AAT search failed, using internal search instead.',
+                exc_info=True)
+            return self.DegradedMatches(self.search_internal(lookuppoi))
+        # Cached clinics may have been fetched for elsewhere in the cell
+        matches = sorted(
+            matches, key=lambda match: self.aat_distance(point, match))
         return [self.format_match_aat(match) for match in matches]
 
+    def search_hybrid(self, lookuppoi):
+        """
+        Searches AAT on a background thread while the internal search
+        runs, merging in whatever AAT returned before
+        LOCATION_HYBRID_DEADLINE
+        """
+        started = time.time()
+        category = self.get_aat_category_id(lookuppoi.search)
+        point = lookuppoi.location.point
+        aat_matches = []
+        aat_failed = []
+
+        def fetch_aat():
+            try:
+                aat_matches.extend(self.cached_aat(category, point))
+            except (aat_client.Unavailable, requests.RequestException,
+                    ValueError):
+                logger.warning('AAT search failed during hybrid search.',
+                               exc_info=True)
+                aat_failed.append(True)
+
+        aat_thread = threading.Thread(target=fetch_aat)
+        aat_thread.daemon = True
+        aat_thread.start()
+
+        ranked = [
+            (match.distance.km, match.data.get('Clinic Name'),
+             self.format_match_internal(match))
+            for match in self.nearest_internal(
+                lookuppoi, settings.LOCATION_SEARCH_RADIUS)]
+        aat_thread.join(max(
+            0, settings.LOCATION_HYBRID_DEADLINE - (time.time() - started)))
+        if aat_thread.is_alive():
+            logger.info('AAT missed the hybrid search deadline.')
+            return self.DegradedMatches(self.merge_ranked(ranked))
+        ranked.extend(
+            (self.aat_distance(point, match),
+             match.get('OrganisationName'), self.format_match_aat(match))
+            for match in aat_matches)
+        if aat_failed:
+            return self.DegradedMatches(self.merge_ranked(ranked))
+        return self.merge_ranked(ranked)
+
+    def merge_ranked(self, ranked):
+        # Nearest first, dropping the same clinic found in both sources
+        matches = []
+        kept = []
+        for distance, name, output in sorted(ranked, key=lambda r: r[0]):
+            name = (name or '').strip().lower()
+            if any(name == kept_name and abs(distance - kept_distance) <=
+                   settings.LOCATION_HYBRID_DUPLICATE_DISTANCE
+                   for kept_distance, kept_name in kept):
+                continue
+            kept.append((distance, name))
+            matches.append(output)
+        return matches[:settings.LOCATION_MAX_RESPONSES]
+
     def get_aat_category_id(self, search):
         category = settings.AAT_DEFAULT_CATEGORY
         for cat_name, cat_value in settings.AAT_CATEGORIES.items():
@@ -322,26 +1126,312 @@ class Location_Finder(Task):
             if key in match.data and match.data[key] != "")
         return "%s (%s)" % (match.data[primary], add_output)
 
+    def nearest_candidates(self, lookuppoi, radius):
+        """
+        Query for the LOCATION_MAX_RESPONSES points of interest matching
+        the lookup's search nearest its point, within radius km
+        """
+        search = lookuppoi.search.copy()
+        search.pop('source', None)
+        point = lookuppoi.location.point
+        # ST_DWithin on the geography column is answered from its spatial
+        # index, so selective filters never walk the whole index
+        matches = PointOfInterest.objects.select_related("location").filter(
+            location__geog__dwithin=(point, Distance(km=radius)))
+        if settings.LOCATION_TYPED_FILTERS:
+            columns, search = PointOfInterest.split_search(search)
+            matches = matches.filter(**columns)
+        if search:
+            matches = matches.filter(data__contains=search)
+        # KNN ordering with <-> walks the geography GiST index nearest
+        # first and stops at the limit, so dense areas only read as many
+        # locations as it takes to find enough matches. Sphere distances need
+        # PostGIS 2.2 on PostgreSQL 9.5 or later. Any other sort key
+        # would force a sort of every match, so ties are broken later.
+        return matches.distance(
+            point, field_name='location__point').extra(
+            select={"knn": '"%s"."geog" <-> ST_GeogFromText(%%s)' %
+                    Location._meta.db_table},
+            select_params=[point.ewkt]).order_by(
+            'knn')[:settings.LOCATION_MAX_RESPONSES]
+
+    def nearest_internal(self, lookuppoi, radius):
+        # Exact distances are checked on the few KNN candidates only
+        matches = [
+            match for match in self.nearest_candidates(lookuppoi, radius)
+            if match.distance.km <= radius]
+        return sorted(matches, key=lambda match: (
+            match.distance.m, match.location_id, match.id))
+
     def search_internal(self, lookuppoi):
-        ringfence = Distance(km=settings.LOCATION_SEARCH_RADIUS)
-        # create location data search dictionary
+        matches = self.nearest_internal(
+            lookuppoi, settings.LOCATION_SEARCH_RADIUS)
+        return [self.format_match_internal(match) for match in matches]
+
+    def search_knn(self, lookuppoi):
+        # Users far from a clinic still get their nearest ones
+        matches = self.nearest_internal(
+            lookuppoi, settings.LOCATION_KNN_MAX_RADIUS)
+        return [self.format_match_internal(match) for match in matches]
+
+    def search_index(self, lookuppoi):
+        # Same search as search_internal, answered from the worker's
+        # in-memory index instead of PostGIS
         search = lookuppoi.search.copy()
         search.pop('source', None)
-        locations = Location.objects.filter(
-            point__distance_lte=(
-                lookuppoi.location.point, ringfence)).filter(
-            location__data__contains=search).distance(
-            lookuppoi.location.point).order_by('distance')
-        matches = []
-        for result in locations:
-            for poi in result.location.all():
-                matches.append(poi)
+        matches = location_index.search(
+            lookuppoi.location.point, settings.LOCATION_SEARCH_RADIUS,
+            search, limit=settings.LOCATION_MAX_RESPONSES)
         return [self.format_match_internal(match) for match in matches]
 
+    def get_precomputed_category(self, search):
+        # Only unfiltered and single category searches are precomputed
+        if not search:
+            return ''
+        if len(search) == 1:
+            category, value = search.items()[0]
+            if category in settings.AAT_CATEGORIES and value == 'true':
+                return category
+        return None
+
+    def search_precomputed(self, lookuppoi):
+        search = lookuppoi.search.copy()
+        search.pop('source', None)
+        category = self.get_precomputed_category(search)
+        if category is not None:
+            point = lookuppoi.location.point
+            cell = geohash(point.x, point.y,
+                           settings.LOCATION_PRECOMPUTE_PRECISION)
+            try:
+                nearest = NearestCell.objects.get(
+                    cell=cell, category=category)
+            except NearestCell.DoesNotExist:
+                pass
+            else:
+                # The cell stores the nearest to its centre, so re-rank
+                # them for the lookup's own point
+                ranked = []
+                for poi in PointOfInterest.objects.select_related(
+                        "location").filter(
+                        id__in=nearest.pointofinterest_ids()):
+                    distance = distance_km(
+                        point.x, point.y,
+                        poi.location.point.x, poi.location.point.y)
+                    if distance <= settings.LOCATION_SEARCH_RADIUS:
+                        ranked.append((distance, poi.location_id, poi.id,
+                                       poi))
+                ranked.sort(key=lambda r: r[:3])
+                return [self.format_match_internal(r[-1])
+                        for r in ranked[:settings.LOCATION_MAX_RESPONSES]]
+        # Outside the precomputed grid
+        return self.search_internal(lookuppoi)
+
 
 location_finder = Location_Finder()
 
 
+class LBS_Pipeline(Task):
+
+    """
+    Task running the LBS lookup, location search and result sending for
+    one LBSRequest in a single pass. State is kept in memory and each
+    row is written once at the end.
+    """
+    name = "clinicfinder.tasks.lbs_pipeline"
+    default_retry_delay = 1
+    max_retries = 5
+
+    def run(self, lbsrequest_id, **kwargs):
+        """
+        Looks up, searches and sends, returning the lookup message
+        """
+        l = self.get_logger(**kwargs)
+
+        l.info("Processing new LBS pipeline")
+        try:
+            lbsrequest = LBSRequest.objects.select_related(
+                "pointofinterest").get(pk=lbsrequest_id)
+        except LBSRequest.DoesNotExist:
+            # Django 1.7 has no on_commit hook, so a request created in a
+            # transaction may not be visible yet
+            raise self.retry()
+        lookuppoi = lbsrequest.pointofinterest
+        lbsrequest.response = {}
+        response = "No response"
+        location = None
+        searching = False
+        # The search and send stages follow straight on, so only the
+        # lookup waits in a queue
+        started = searched = time.time()
+        lbs_timings = search_timings = {}
+        delivered = False
+        try:
+            previous = lbs_lookup.recent_lookup(lbsrequest)
+            if previous is not None:
+                response, location = lbs_lookup.reuse_lookup(
+                    lbsrequest, previous)
+            else:
+                whitelist, result = lbs_lookup.whitelisted_location(
+                    lbsrequest.search["msisdn"])
+                response, location = lbs_lookup.record_result(
+                    lbsrequest, whitelist, result)
+            looked_up = time.time()
+            lbs_timings = stage_timings(
+                "lbs", epoch(lbsrequest.created_at), started, looked_up)
+            # Skipped if a save elsewhere already queued a search
+            if location is not None and LookupPointOfInterest.transition(
+                    lookuppoi.id, (LookupPointOfInterest.PENDING,),
+                    LookupPointOfInterest.SEARCHING):
+                searching = True
+                lookuppoi.location = location
+                matches = location_finder.find(lookuppoi)
+                lookuppoi.response["results"] = ' AND '.join(matches)
+                l.info("Completed location search. Found: %s" %
+                       str(len(matches)))
+                searched = time.time()
+                search_timings = stage_timings(
+                    "search", None, looked_up, searched)
+                location_sender.deliver(lookuppoi)
+                delivered = True
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing LBS pipeline via \
+                Celery.',
+                exc_info=True)
+        finally:
+            # Whatever was done is written even when a stage failed
+            searched_only = (searching and not delivered and
+                             "results" in lookuppoi.response)
+            with transaction.atomic():
+                if location is not None:
+                    if location.pk is None:
+                        location.save()
+                    columns = {"location": location}
+                    if delivered:
+                        finished = time.time()
+                        record_timing("total_ms", (
+                            finished - epoch(lookuppoi.created_at)) * 1000)
+                        columns["status"] = LookupPointOfInterest.DONE
+                        columns["timings"] = dict(
+                            search_timings, **stage_timings(
+                                "send", None, searched, finished))
+                    elif searched_only:
+                        # Not sent, the send stage tries again
+                        columns["status"] = LookupPointOfInterest.SEARCHED
+                        columns["timings"] = search_timings
+                    elif searching:
+                        # Pending again if the search did not finish
+                        columns["status"] = LookupPointOfInterest.PENDING
+                    lookuppoi.update_hstore(
+                        "response", lookuppoi.response, **columns)
+                lbsrequest.update_hstore(
+                    "response", lbsrequest.response, timings=lbs_timings)
+            if "results" in lookuppoi.response:
+                location_finder.share_results(lookuppoi)
+            if searched_only:
+                location_finder.queue_send(lookuppoi.id)
+        return response
+
+lbs_pipeline = LBS_Pipeline()
+
+
+class Nearest_Precomputer(Task):
+
+    """
+    Task to precompute the nearest points of interest per grid cell
+    """
+    name = "clinicfinder.tasks.nearest_precomputer"
+
+    def categories(self):
+        return [('', {})] + [
+            (category, {category: 'true'})
+            for category in settings.AAT_CATEGORIES]
+
+    def run(self, points=None, **kwargs):
+        """
+        Rebuilds the cells within search radius of points, a list of
+        [x, y] pairs, or of every location when points is None. Returns
+        count of cells stored.
+        """
+        l = self.get_logger(**kwargs)
+
+        l.info("Processing nearest clinic precompute")
+        precision = settings.LOCATION_PRECOMPUTE_PRECISION
+        radius = settings.LOCATION_SEARCH_RADIUS
+        rebuild_all = points is None
+        if rebuild_all:
+            points = [(location.point.x, location.point.y)
+                      for location in Location.objects.all()]
+        cells = set()
+        for x, y in points:
+            cells.update(geohash_cells_near(x, y, radius, precision))
+        rows = []
+        try:
+            for cell in cells:
+                centre = Point(*geohash_centre(cell))
+                for category, search in self.categories():
+                    matches = location_index.search(
+                        centre, radius, search,
+                        limit=settings.LOCATION_PRECOMPUTE_TOP_K)
+                    if matches:
+                        rows.append(NearestCell(
+                            cell=cell, category=category,
+                            pointsofinterest=','.join(
+                                str(match.poi_id) for match in matches)))
+            with transaction.atomic():
+                if rebuild_all:
+                    NearestCell.objects.all().delete()
+                else:
+                    cells = list(cells)
+                    for start in range(0, len(cells), 1000):
+                        NearestCell.objects.filter(
+                            cell__in=cells[start:start + 1000]).delete()
+                NearestCell.objects.bulk_create(rows, batch_size=1000)
+            l.info("Precomputed <%s> cells" % len(rows))
+            return len(rows)
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing nearest clinic \
+                 precompute via Celery.',
+                exc_info=True)
+
+nearest_precomputer = Nearest_Precomputer()
+
+
+class AAT_Cache_Refresher(Task):
+
+    """
+    Task to refresh a stale cached AAT search
+    """
+    name = "clinicfinder.tasks.aat_cache_refresher"
+
+    def run(self, category, x, y, **kwargs):
+        l = self.get_logger(**kwargs)
+
+        point = Point(x, y)
+        aat_cache = caches[settings.AAT_CACHE_ALIAS]
+        key = location_finder.aat_cache_key(category, point)
+        l.info("Refreshing cached AAT search <%s>" % key)
+        try:
+            clinics = location_finder.fetch_aat(category, x, y)
+            aat_cache.set(key, {'fetched_at': time.time(),
+                                'clinics': clinics},
+                          settings.AAT_CACHE_TIMEOUT)
+            return len(clinics)
+        except (aat_client.Unavailable, requests.RequestException,
+                ValueError):
+            l.info("Failed to refresh cached AAT search <%s>" % key)
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed refreshing AAT search \
+                 via Celery.',
+                exc_info=True)
+        finally:
+            aat_cache.delete(key + '.refreshing')
+
+aat_cache_refresher = AAT_Cache_Refresher()
+
+
 class PointOfInterest_Importer(Task):
 
     """
@@ -365,37 +1455,47 @@ class PointOfInterest_Importer(Task):
         l.info("Processing new point of interest import data")
         imported = 0
         row = 0
+        points = []
         try:
-            for line in poidata:
-                row += 1
-                if "Latitude" in line and "Longitude" in line:
-                    if line["Longitude"] != "" and line["Latitude"] != "":
-                        poi_point = Point(float(line["Longitude"]),
-                                          float(line["Latitude"]))
-                        # check if point exists
-                        locations = Location.objects.filter(point=poi_point)
-                        if locations.count() == 0:
-                            # make a Location
-                            location = Location()
-                            location.point = poi_point
-                            location.save()
+            # Search indexes and caches are refreshed once at the end
+            # rather than for every row
+            with defer_data_version():
+                for line in poidata:
+                    row += 1
+                    if "Latitude" in line and "Longitude" in line:
+                        if (line["Longitude"] != "" and
+                                line["Latitude"] != ""):
+                            poi_point = Point(float(line["Longitude"]),
+                                              float(line["Latitude"]))
+                            # check if point exists
+                            locations = Location.objects.filter(
+                                point=poi_point)
+                            if locations.count() == 0:
+                                # make a Location
+                                location = Location()
+                                location.point = poi_point
+                                location.save()
+                            else:
+                                # Grab the top of the stack
+                                location = locations[0]
+                            # Create new point of interest with location
+                            poi = PointOfInterest()
+                            poi.location = location
+                            poi.data = line
+                            poi.save()
+                            imported += 1
+                            points.append([poi_point.x, poi_point.y])
+                            l.info("Imported: %s" % line["Clinic Name"])
                         else:
-                            # Grab the top of the stack
-                            location = locations[0]
-                        # Create new point of interest with location
-                        poi = PointOfInterest()
-                        poi.location = location
-                        poi.data = line
-                        poi.save()
-                        imported += 1
-                        l.info("Imported: %s" % line["Clinic Name"])
+                            l.info(
+                                "Row <%s> has corrupted point data, "
+                                "not imported" % row)
                     else:
-                        l.info(
-                            "Row <%s> has corrupted point data, "
-                            "not imported" % row)
-                else:
-                    l.info("Row <%s> missing point data, not imported" % row)
+                        l.info("Row <%s> missing point data, "
+                               "not imported" % row)
             l.info("Imported <%s> locations" % str(imported))
+            if points and settings.LOCATION_PRECOMPUTE_ON_IMPORT:
+                nearest_precomputer.delay(points=points)
             return imported
         except SoftTimeLimitExceeded:
             logger.error(
@@ -404,3 +1504,53 @@ class PointOfInterest_Importer(Task):
                 exc_info=True)
 
 pointofinterest_importer = PointOfInterest_Importer()
+
+
+class Task_Result_Purger(Task):
+
+    """
+    Task to delete djcelery task results older than
+    TASK_RESULT_PURGE_AGE, TASK_RESULT_PURGE_BATCH_SIZE rows at a time
+    """
+    name = "clinicfinder.tasks.task_result_purger"
+
+    def purge(self, model, cutoff):
+        """
+        Deletes one batch, returning the number of rows deleted
+        """
+        ids = list(model.objects.filter(date_done__lt=cutoff).order_by(
+            "id").values_list("id", flat=True)[
+            :settings.TASK_RESULT_PURGE_BATCH_SIZE])
+        if ids:
+            model.objects.filter(pk__in=ids).delete()
+        return len(ids)
+
+    def run(self, **kwargs):
+        """
+        Returns count of deleted results. Whatever is left after
+        TASK_RESULT_PURGE_TIME seconds waits for the next run.
+        """
+        l = self.get_logger(**kwargs)
+
+        cutoff = timezone.now() - timedelta(
+            seconds=settings.TASK_RESULT_PURGE_AGE)
+        deadline = time.time() + settings.TASK_RESULT_PURGE_TIME
+        deleted = 0
+        try:
+            for model in (TaskMeta, TaskSetMeta):
+                while time.time() < deadline:
+                    count = self.purge(model, cutoff)
+                    deleted += count
+                    if count < settings.TASK_RESULT_PURGE_BATCH_SIZE:
+                        break
+                    # Gives searches a turn at the database
+                    time.sleep(settings.TASK_RESULT_PURGE_PAUSE)
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed purging task results \
+                 via Celery.',
+                exc_info=True)
+        l.info("Purged <%s> task results" % str(deleted))
+        return deleted
+
+task_result_purger = Task_Result_Purger()
@@ -1,22 +1,43 @@
 import json
+import mock
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+import requests
 import responses
+from django.core.cache import cache, caches
+from django.db import connection, OperationalError
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import Point
+from django.utils import timezone
+from djcelery.models import TaskMeta
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
-from go_http.send import LoggingSender
+from go_http.send import HttpApiSender, LoggingSender
 
 from .models import (Location, PointOfInterest,
                      LookupLocation, LookupPointOfInterest,
-                     LBSRequest)
-
-from .tasks import (Location_Sender, LBS_Lookup,
-                    PointOfInterest_Importer, Metric_Sender, metric_sender)
+                     LBSRequest, NearestCell)
+
+from .tasks import (Location_Sender, Location_Finder, LBS_Lookup,
+                    LBS_Batch_Lookup, Location_Batch_Sender,
+                    PointOfInterest_Importer, Metric_Sender, metric_sender,
+                    location_finder, location_sender, nearest_precomputer,
+                    lbs_lookup, lbs_batch_lookup, location_batch_sender,
+                    pointofinterest_importer, task_result_purger)
+from .spatial import location_index, bump_data_version, geohash
+from .clients import (aat_client, lbs_client, lbs_rate_limiter, vumi_client,
+                      RateLimiter)
+from .fakes import FakeService, FakeLBS, FakeVumi
+from .metrics import MetricsBuffer
+from .management.commands.benchmark_pipeline import summarise
 
 
 class APITestCase(TestCase):
@@ -248,6 +269,454 @@ class TestClinicFinderDataStorage(AuthenticatedAPITestCase):
         lpoi = LookupPointOfInterest.objects.last()
         self.assertEqual(lpoi.location, None)
 
+    def test_create_lbsrequest_reuses_recent_location(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        LBS_Lookup.get_location = self.stub_get_location_get_result
+        cache.clear()
+
+        first = None
+        for msisdn in ("27123", "+27123"):
+            post_data = {
+                "search": {
+                    "msisdn": msisdn
+                },
+                "pointofinterest":
+                    self.create_poi_lookup('requestlookup', {"mmc": "true"})
+            }
+            with mock.patch.object(
+                    LBS_Lookup, "get_location",
+                    side_effect=self.stub_get_location_get_result) as lookup:
+                with self.settings(LOCATION_COALESCE_WINDOW=0):
+                    self.client.post('/clinicfinder/lbsrequest/',
+                                     json.dumps(post_data),
+                                     content_type='application/json')
+            if first is None:
+                first = LBSRequest.objects.last()
+                self.assertEqual(lookup.call_count, 1)
+
+        # Second request answered without calling the LBS API
+        self.assertEqual(lookup.call_count, 0)
+        lbs = LBSRequest.objects.last()
+        self.assertEqual(lbs.response["reused_from"], str(first.id))
+        self.assertNotIn("lookup_code", lbs.response)
+        self.assertEqual(lbs.pointofinterest.location,
+                         first.pointofinterest.location)
+        self.assertEqual(lbs.pointofinterest.response["results"],
+                         "Seapoint Clinic (Seapoint)")
+
+        # Outside the window the LBS API is called again
+        with self.settings(LBS_LOCATION_REUSE_WINDOW=0):
+            self.assertEqual(lbs_lookup.recent_lookup(lbs), None)
+
+    def test_create_lbsrequest_coalesces_duplicates(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        cache.clear()
+
+        with mock.patch.object(
+                LBS_Lookup, "get_location",
+                side_effect=self.stub_get_location_get_result) as lookup:
+            for msisdn in ("27123", "+27123"):
+                post_data = {
+                    "search": {
+                        "msisdn": msisdn
+                    },
+                    "pointofinterest":
+                        self.create_poi_lookup(
+                            'requestlookup', {"mmc": "true"})
+                }
+                self.client.post('/clinicfinder/lbsrequest/',
+                                 json.dumps(post_data),
+                                 content_type='application/json')
+        self.assertEqual(lookup.call_count, 1)
+
+        first, second = LBSRequest.objects.order_by("id")
+        self.assertEqual(second.response["coalesced_with"], str(first.id))
+        lpoi = second.pointofinterest
+        self.assertEqual(lpoi.response["coalesced_with"],
+                         str(first.pointofinterest.id))
+        self.assertEqual(lpoi.response["results"],
+                         "Seapoint Clinic (Seapoint)")
+        self.assertEqual(lpoi.response["sent"], "coalesced")
+        self.assertEqual(lpoi.location, first.pointofinterest.location)
+
+    def test_coalesce_shares_results_finished_meanwhile(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        LBS_Lookup.get_location = self.stub_get_location_get_result
+        cache.clear()
+        post_data = {
+            "search": {
+                "msisdn": "27123"
+            },
+            "pointofinterest":
+                self.create_poi_lookup('requestlookup', {"mmc": "true"})
+        }
+        self.client.post('/clinicfinder/lbsrequest/',
+                         json.dumps(post_data),
+                         content_type='application/json')
+        leader = LBSRequest.objects.last().pointofinterest
+        with mock.patch("clinicfinder.models.lbs_lookup"):
+            follower = LBSRequest.objects.create(
+                search={"msisdn": "27123"},
+                pointofinterest=LookupPointOfInterest.objects.create(
+                    search={"mmc": "true"}, response={"type": "SMS"}))
+        # The leader finishes between being read and coalesced_with being
+        # written, so never sees this request
+        stale = LookupPointOfInterest.objects.get(pk=leader.id)
+        del stale.response["results"]
+        with mock.patch.object(LookupPointOfInterest.objects, "get",
+                               side_effect=[stale, leader]):
+            self.assertTrue(lbs_lookup.coalesce(follower))
+        lpoi = LookupPointOfInterest.objects.get(
+            pk=follower.pointofinterest_id)
+        self.assertEqual(lpoi.response["results"],
+                         "Seapoint Clinic (Seapoint)")
+        self.assertEqual(lpoi.response["sent"], "coalesced")
+
+    def test_create_lbsrequest_batch_mode(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        LBS_Lookup.get_location = self.stub_get_location_get_result
+        cache.clear()
+        # Hold the batch back until every request is queued
+        cache.set(LBS_Batch_Lookup.SCHEDULED_KEY, True)
+
+        with self.settings(LBS_LOOKUP_MODE="batch", LBS_BATCH_SIZE=2):
+            for msisdn in ("27123", "27124", "27125"):
+                post_data = {
+                    "search": {
+                        "msisdn": msisdn
+                    },
+                    "pointofinterest":
+                        self.create_poi_lookup(
+                            'requestlookup', {"mmc": "true"})
+                }
+                self.client.post('/clinicfinder/lbsrequest/',
+                                 json.dumps(post_data),
+                                 content_type='application/json')
+            for lbs in LBSRequest.objects.all():
+                self.assertEqual(lbs.response, {"queued": "batch"})
+
+            result = lbs_batch_lookup.delay()
+
+        self.assertEqual(result.get(), 3)
+        for lbs in LBSRequest.objects.all():
+            self.assertEqual(lbs.response["lookup_code"], "101")
+            self.assertNotIn("queued", lbs.response)
+            self.assertEqual(lbs.pointofinterest.response["results"],
+                             "Seapoint Clinic (Seapoint)")
+
+    def test_lbs_batch_reclaims_expired_claims(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        LBS_Lookup.get_location = self.stub_get_location_get_result
+        cache.clear()
+        cache.set(LBS_Batch_Lookup.SCHEDULED_KEY, True)
+
+        with self.settings(LBS_LOOKUP_MODE="batch"):
+            for msisdn in ("27123", "27124"):
+                self.client.post('/clinicfinder/lbsrequest/', json.dumps({
+                    "search": {"msisdn": msisdn},
+                    "pointofinterest": self.create_poi_lookup(
+                        'requestlookup', {"mmc": "true"})
+                }), content_type='application/json')
+            dead, live = LBSRequest.objects.order_by("id")
+            # Claimed by batches that never finished, one long ago
+            LBSRequest.objects.filter(pk=dead.pk).update(response={
+                "queued": "claimed", "claimed_at": "%.3f" % (
+                    time.time() - settings.LBS_BATCH_CLAIM_TIMEOUT - 1)})
+            LBSRequest.objects.filter(pk=live.pk).update(response={
+                "queued": "claimed", "claimed_at": "%.3f" % time.time()})
+
+            self.assertEqual(lbs_batch_lookup.delay().get(), 1)
+
+        dead = LBSRequest.objects.get(pk=dead.pk)
+        self.assertEqual(dead.response["lookup_code"], "101")
+        self.assertNotIn("claimed_at", dead.response)
+        self.assertEqual(LBSRequest.objects.get(pk=live.pk).response["queued"],
+                         "claimed")
+
+    def test_lbs_batch_claim_keeps_other_response_keys(self):
+        cache.clear()
+        cache.set(LBS_Batch_Lookup.SCHEDULED_KEY, True)
+        with self.settings(LBS_LOOKUP_MODE="batch"):
+            self.client.post('/clinicfinder/lbsrequest/', json.dumps({
+                "search": {"msisdn": "27123"},
+                "pointofinterest": self.create_poi_lookup(
+                    'requestlookup', {"mmc": "true"})
+            }), content_type='application/json')
+        lbs = LBSRequest.objects.last()
+        lbs.update_hstore("response", {"note": "kept"})
+        self.assertEqual(lbs_batch_lookup.claim(), [lbs])
+        lbs = LBSRequest.objects.get(pk=lbs.pk)
+        self.assertEqual(lbs.response["queued"], "claimed")
+        self.assertEqual(lbs.response["note"], "kept")
+
+    def test_lbs_batch_lookup_error_recorded_as_single_lookup(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        cache.clear()
+        cache.set(LBS_Batch_Lookup.SCHEDULED_KEY, True)
+        with mock.patch.object(LBS_Lookup, "get_location",
+                               side_effect=requests.ConnectionError()):
+            for mode, msisdn in (("single", "27123"), ("batch", "27124")):
+                with self.settings(LBS_LOOKUP_MODE=mode):
+                    self.client.post('/clinicfinder/lbsrequest/', json.dumps({
+                        "search": {"msisdn": msisdn},
+                        "pointofinterest": self.create_poi_lookup(
+                            'requestlookup', {"mmc": "true"})
+                    }), content_type='application/json')
+            self.assertEqual(lbs_batch_lookup.delay().get(), 1)
+        single, batch = LBSRequest.objects.order_by("id")
+        # The whitelist succeeded so neither blames it
+        self.assertEqual(batch.response, single.response)
+        self.assertNotIn("whitelist_code", batch.response)
+
+    def test_create_lbsrequest_pipeline_mode(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        LBS_Lookup.get_location = self.stub_get_location_get_result
+        cache.clear()
+
+        post_data = {
+            "search": {
+                "msisdn": "27123"
+            },
+            "pointofinterest":
+                self.create_poi_lookup('requestlookup', {"mmc": "true"})
+        }
+        with self.settings(LBS_LOOKUP_MODE="pipeline"), \
+                mock.patch.object(location_finder, "delay") as finder, \
+                mock.patch.object(location_sender, "delay") as sender:
+            self.client.post('/clinicfinder/lbsrequest/',
+                             json.dumps(post_data),
+                             content_type='application/json')
+        # Every stage ran in the one task
+        self.assertFalse(finder.called)
+        self.assertFalse(sender.called)
+
+        lbs = LBSRequest.objects.last()
+        self.assertEqual(lbs.response["lookup_code"], "101")
+        lpoi = lbs.pointofinterest
+        self.assertEqual(lpoi.location.point,
+                         Point(17.9145812988280005, -32.7461242675779979))
+        self.assertEqual(lpoi.response["results"],
+                         "Seapoint Clinic (Seapoint)")
+        self.assertEqual(lpoi.response["sent"], "true")
+
+    def test_pipeline_saves_progress_when_send_fails(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        LBS_Lookup.add_allowed_msisdn = self.stub_add_allowed_msisdn
+        LBS_Lookup.get_location = self.stub_get_location_get_result
+        cache.clear()
+
+        post_data = {
+            "search": {
+                "msisdn": "27123"
+            },
+            "pointofinterest":
+                self.create_poi_lookup('requestlookup', {"mmc": "true"})
+        }
+        with self.settings(LBS_LOOKUP_MODE="pipeline"), \
+                mock.patch.object(
+                    location_sender, "deliver",
+                    side_effect=requests.HTTPError("503")), \
+                mock.patch.object(location_sender, "delay") as sender:
+            with self.assertRaises(requests.HTTPError):
+                self.client.post('/clinicfinder/lbsrequest/',
+                                 json.dumps(post_data),
+                                 content_type='application/json')
+        lbs = LBSRequest.objects.last()
+        self.assertEqual(lbs.response["lookup_code"], "101")
+        self.assertIn("lbs_finished", lbs.timings)
+        lpoi = LookupPointOfInterest.objects.get(pk=lbs.pointofinterest_id)
+        self.assertEqual(lpoi.location.point,
+                         Point(17.9145812988280005, -32.7461242675779979))
+        self.assertEqual(lpoi.response["results"],
+                         "Seapoint Clinic (Seapoint)")
+        self.assertNotIn("sent", lpoi.response)
+        # Searched, with sending handed on to the send stage
+        self.assertEqual(lpoi.status, LookupPointOfInterest.SEARCHED)
+        sender.assert_called_once_with(lpoi.id, queued_at=mock.ANY)
+
+    def test_update_hstore_merges_keys_without_signals(self):
+        lookup = LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, response={"type": "SMS"})
+        stale = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        location = LookupLocation.objects.create(point=Point(18.0, -33.0))
+
+        with mock.patch.object(location_finder, "delay") as finder:
+            lookup.update_hstore("response", {"results": "Clinic"},
+                                 location=location)
+            stale.update_hstore("response", {"sent": "true"})
+        self.assertFalse(finder.called)
+        self.assertEqual(lookup.response["results"], "Clinic")
+
+        lookup = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        self.assertEqual(lookup.response, {
+            "type": "SMS", "results": "Clinic", "sent": "true"})
+        self.assertEqual(lookup.location, location)
+
+    def test_lookup_searched_and_sent_once(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        location = LookupLocation.objects.create(
+            point=Point(17.9145812988280005, -32.7461242675779979))
+        lookup = LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, location=location,
+            response=self.create_poi_lookup('requestlookup', {})["response"])
+        lookup = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        self.assertEqual(lookup.status, LookupPointOfInterest.DONE)
+        self.assertEqual(lookup.response["sent"], "true")
+
+        # Later saves and duplicate tasks do nothing, the tasks without
+        # loading the row
+        with mock.patch.object(location_finder, "delay") as finder:
+            lookup.response.pop("results")
+            lookup.save()
+        self.assertFalse(finder.called)
+        with self.assertNumQueries(1):
+            self.assertFalse(location_finder.delay(lookup.id).get())
+        with self.assertNumQueries(1):
+            self.assertEqual(location_sender.delay(lookup.id).get(), None)
+
+    def test_stale_save_keeps_task_status(self):
+        lookup = LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, response={})
+        stale = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        LookupPointOfInterest.objects.filter(pk=lookup.pk).update(
+            status=LookupPointOfInterest.DONE, timings={"send_finished": "1"})
+        stale.response["type"] = "SMS"
+        stale.save()
+        lookup = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        self.assertEqual(lookup.response["type"], "SMS")
+        self.assertEqual(lookup.status, LookupPointOfInterest.DONE)
+        self.assertEqual(lookup.timings, {"send_finished": "1"})
+
+    def test_failed_stages_return_lookup_to_previous_status(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        location = LookupLocation.objects.create(
+            point=Point(17.9145812988280005, -32.7461242675779979))
+        response = self.create_poi_lookup('requestlookup', {})["response"]
+        with mock.patch.object(Location_Finder, "find",
+                               side_effect=ValueError("bad search")):
+            with self.assertRaises(ValueError):
+                LookupPointOfInterest.objects.create(
+                    search={"mmc": "true"}, location=location,
+                    response=response)
+        lookup = LookupPointOfInterest.objects.last()
+        self.assertEqual(lookup.status, LookupPointOfInterest.PENDING)
+
+        with mock.patch.object(Location_Sender, "deliver",
+                               side_effect=requests.HTTPError("503")):
+            with self.assertRaises(requests.HTTPError):
+                location_finder.queue(lookup)
+        lookup = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        self.assertEqual(lookup.status, LookupPointOfInterest.SEARCHED)
+        self.assertIn("results", lookup.response)
+
+    def test_stages_record_timings(self):
+        Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        location = LookupLocation.objects.create(
+            point=Point(17.9145812988280005, -32.7461242675779979))
+        lookup = LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, location=location,
+            response=self.create_poi_lookup('requestlookup', {})["response"])
+        lookup = LookupPointOfInterest.objects.get(pk=lookup.pk)
+        self.assertEqual(sorted(lookup.timings), [
+            "search_finished", "search_queued", "search_started",
+            "send_finished", "send_queued", "send_started"])
+        timings = [float(lookup.timings[key]) for key in (
+            "search_queued", "search_started", "search_finished",
+            "send_queued", "send_started", "send_finished")]
+        self.assertEqual(timings, sorted(timings))
+
+    def test_location_sender_suppresses_duplicate_message(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        response = {
+            "type": "SMS",
+            "to_addr": "+27123",
+            "template": "Your nearest is: {{ results }}",
+            "results": "Seapoint Clinic (Seapoint)"
+        }
+        lookups = [LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, response=response) for _ in range(2)]
+
+        sender = LoggingSender('go_http.test')
+        with mock.patch.object(Location_Sender, "vumi_client",
+                               lambda x: sender):
+            with mock.patch.object(sender, "send_text",
+                                   wraps=sender.send_text) as send_text:
+                for lookup in lookups:
+                    location_sender.delay(lookup.id)
+        self.assertEqual(send_text.call_count, 1)
+        first, second = [LookupPointOfInterest.objects.get(pk=lookup.id)
+                         for lookup in lookups]
+        self.assertEqual(first.response["sent"], "true")
+        self.assertEqual(second.response["sent"], "suppressed")
+
+    def test_location_batch_sender_sends_searched_lookups(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        lookups = [LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, response={
+                "type": "SMS",
+                "to_addr": "+2712%s" % i,
+                "template": "Your nearest is: {{ results }}",
+                "results": "Seapoint Clinic (Seapoint)"
+            }) for i in range(3)]
+        LookupPointOfInterest.objects.filter(
+            pk__in=[lookup.id for lookup in lookups]).update(
+            status=LookupPointOfInterest.SEARCHED)
+
+        sender = LoggingSender('go_http.test')
+        down = set(["+27120"])
+
+        def send_text(to_addr, content):
+            if to_addr in down:
+                raise requests.ConnectionError("Vumi Go is down")
+            return {"success": True}
+
+        with mock.patch.object(Location_Sender, "vumi_client",
+                               lambda x: sender), \
+                mock.patch.object(sender, "send_text",
+                                  side_effect=send_text) as sent, \
+                mock.patch.object(Location_Batch_Sender,
+                                  "apply_async") as retry:
+            self.assertEqual(location_batch_sender.run(), 2)
+            unsent, first, second = [
+                LookupPointOfInterest.objects.get(pk=lookup.id)
+                for lookup in lookups]
+            self.assertEqual(unsent.status, LookupPointOfInterest.SEARCHED)
+            self.assertNotIn("sent", unsent.response)
+            for lookup in (first, second):
+                self.assertEqual(lookup.status, LookupPointOfInterest.DONE)
+                self.assertEqual(lookup.response["sent"], "true")
+            # A follow-up batch is scheduled for the unsent message
+            retry.assert_called_once_with(
+                countdown=settings.LOCATION_SEND_RETRY_DELAY)
+
+            # Sent, not suppressed as a duplicate, once Vumi Go is back
+            down.clear()
+            self.assertEqual(location_batch_sender.run(), 1)
+        unsent = LookupPointOfInterest.objects.get(pk=unsent.id)
+        self.assertEqual(unsent.status, LookupPointOfInterest.DONE)
+        self.assertEqual(unsent.response["sent"], "true")
+        self.assertEqual(sent.call_count, 4)
+
     def check_lookuppoi_post_result(self, point, results, search):
         Location_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
         Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
@@ -310,8 +779,85 @@ class TestClinicFinderDataStorage(AuthenticatedAPITestCase):
             }
         )
 
+    def test_create_lookuppointofinterest_model_index_result_hct(self):
+        """Test POI lookup answered from the in-memory location index
+           matches the internal database search.
+           """
+        self.check_lookuppoi_post_result(
+            point=(18.71208, -33.85105),
+            results=(
+                "Harmonie Clinic (0219806185/6205) "
+                "AND Hazendal Satellite Clinic (216969920)"
+            ),
+            search={
+                "hct": "true",
+                "source": "index",
+            }
+        )
+
+    def test_create_lookuppointofinterest_model_knn_result_mmc(self):
+        """Test POI lookup that finds the nearest clinics beyond the
+           search radius.
+           """
+        self.check_lookuppoi_post_result(
+            point=(28.0, -27.5),
+            results=(
+                "Tokollo Hospital (Myron Street, Heilbron, 058 813 1391) "
+                "AND Boitumelo Hospital (Smaldeel road, Kroonstad, "
+                "056 216 5200)"
+            ),
+            search={
+                "mmc": "true",
+                "source": "knn",
+            }
+        )
+
+    @override_settings(LOCATION_PRECOMPUTE_PRECISION=5)
+    def test_create_lookuppointofinterest_model_precomputed_result_hct(self):
+        """Test POI lookup answered from the precomputed grid table."""
+        nearest_precomputer.run()
+        self.assertTrue(NearestCell.objects.filter(category="hct").exists())
+        self.check_lookuppoi_post_result(
+            point=(18.71208, -33.85105),
+            results=(
+                "Harmonie Clinic (0219806185/6205) "
+                "AND Hazendal Satellite Clinic (216969920)"
+            ),
+            search={
+                "hct": "true",
+                "source": "precomputed",
+            }
+        )
+
+    @override_settings(LOCATION_PRECOMPUTE_PRECISION=5)
+    def test_create_lookuppointofinterest_precomputed_outside_grid(self):
+        """Test precomputed POI lookup falls back to the database search
+           outside the grid.
+           """
+        nearest_precomputer.run()
+        self.check_lookuppoi_post_result(
+            point=(29.0000000, -33.0000000),
+            results="",
+            search={
+                "mmc": "true",
+                "source": "precomputed",
+            })
+
+    def test_location_index_reloads_on_poi_save(self):
+        point = Point(18.71208, -33.85105)
+        before = location_index.search(point, 1, {"hct": "true"})
+        location = Location.objects.create(point=point)
+        PointOfInterest.objects.create(
+            location=location,
+            data={"Clinic Name": "New Clinic", "hct": "true"})
+        after = location_index.search(point, 1, {"hct": "true"})
+        self.assertEqual(len(after), len(before) + 1)
+        self.assertIn("New Clinic",
+                      [match.data["Clinic Name"] for match in after])
+
     @responses.activate
     def check_lookuppoi_aat_result(self, point, results, search, category):
+        caches[settings.AAT_CACHE_ALIAS].clear()
         point_x, point_y = point
 
         response_json = {
@@ -404,6 +950,103 @@ class TestClinicFinderDataStorage(AuthenticatedAPITestCase):
                           "Metrics published")
 
 
+class TestStageLatencyReport(AuthenticatedAPITestCase):
+
+    def test_report_percentiles(self):
+        lookups = [LookupPointOfInterest.objects.create(
+            search={"mmc": "true"}, response={}) for i in range(5)]
+        for i, lookup in enumerate(lookups):
+            LookupPointOfInterest.objects.filter(pk=lookup.pk).update(
+                timings={
+                    "search_queued": "1000.000",
+                    "search_started": "1000.100",
+                    "search_finished": "%.3f" % (1000.11 + i * 0.01),
+                })
+        response = self.client.get(reverse('stage-latency'),
+                                   {"minutes": 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stages = response.data["stages"]
+        self.assertEqual(stages["lbs"]["count"], 0)
+        self.assertEqual(stages["send"]["count"], 0)
+        self.assertEqual(stages["search"]["count"], 5)
+        self.assertEqual(stages["search"]["wait_ms"],
+                         {"p50": 100.0, "p95": 100.0, "p99": 100.0})
+        self.assertEqual(stages["search"]["run_ms"],
+                         {"p50": 30.0, "p95": 48.0, "p99": 49.6})
+
+    def test_report_rejects_bad_window(self):
+        response = self.client.get(reverse('stage-latency'),
+                                   {"minutes": "soon"})
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+class TestNearestClinicAPI(AuthenticatedAPITestCase):
+
+    fixtures = ["test_data.json", "test_multi_data.json"]
+
+    def test_nearest_returns_matches_inline(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        lookups = LookupPointOfInterest.objects.count()
+        with mock.patch.object(Location_Sender, "delay") as send:
+            response = self.client.get(reverse('nearest'), {
+                "lon": "17.9145812988280005",
+                "lat": "-32.7461242675779979",
+                "mmc": "true",
+            })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"],
+                         ["Seapoint Clinic (Seapoint)"])
+        self.assertEqual(response.data["source"], "internal")
+        self.assertEqual(LookupPointOfInterest.objects.count(), lookups)
+        self.assertFalse(send.called)
+
+    def test_nearest_rejects_bad_point(self):
+        response = self.client.get(reverse('nearest'), {
+            "lon": "17.9", "lat": "-132.7", "source": "aat"})
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(sorted(response.data), ["lat", "source"])
+
+    def database_error(self, pgcode):
+        error = OperationalError("database error")
+        error.__cause__ = mock.Mock(pgcode=pgcode)
+        return error
+
+    def test_nearest_over_budget(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        # Query canceled, as raised by statement_timeout
+        with mock.patch.object(location_finder, "find",
+                               side_effect=self.database_error("57014")):
+            response = self.client.get(reverse('nearest'), {
+                "lon": "17.9", "lat": "-32.7"})
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_nearest_other_database_errors_raised(self):
+        # Connection failure
+        with mock.patch.object(location_finder, "find",
+                               side_effect=self.database_error("08006")):
+            with self.assertRaises(OperationalError):
+                self.client.get(reverse('nearest'), {
+                    "lon": "17.9", "lat": "-32.7"})
+
+    def test_nearest_restores_callers_statement_timeout(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cursor = connection.cursor()
+        # Tests run in a transaction, as the benchmark does
+        cursor.execute("SET LOCAL statement_timeout = '7s'")
+        location_finder.find_nearest(17.9, -32.7, {"mmc": "true"})
+        cursor.execute("SHOW statement_timeout")
+        self.assertEqual(cursor.fetchone()[0], "7s")
+
+    def test_nearest_refuses_index_source(self):
+        response = self.client.get(reverse('nearest'), {
+            "lon": "17.9", "lat": "-32.7", "source": "index"})
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
 class TestUploadPoiCSV(TestCase):
 
     CSV_LINE_CLEAN_1 = {'Area 1': 'Pixley ka Seme',
@@ -508,6 +1151,557 @@ class TestUploadPoiCSV(TestCase):
         new_pois = PointOfInterest.objects.all().count()
         self.assertEquals(new_pois, 1)
 
+    def test_upload_csv_bumps_data_version_once(self):
+        with mock.patch("clinicfinder.spatial.bump_data_version") as bump, \
+                mock.patch("clinicfinder.models.bump_data_version") as row:
+            results = PointOfInterest_Importer.delay(
+                [self.CSV_LINE_CLEAN_1, self.CSV_LINE_CLEAN_2])
+            self.assertEqual(results.get(), 2)
+            self.assertEqual(bump.call_count, 1)
+            self.assertFalse(row.called)
+            # Saves outside an import still bump straight away
+            Location.objects.create(point=Point(22.7, -29.6))
+            self.assertEqual(row.call_count, 1)
+
+
+class TestLocationFinderQueries(TestCase):
+
+    def create_clinics(self, count, x=18.5, y=-33.9):
+        for i in range(count):
+            location = Location.objects.create(
+                point=Point(x + i * 0.0001, y))
+            PointOfInterest.objects.create(
+                location=location,
+                data={"Clinic Name": "Clinic %s" % i, "hct": "true"})
+
+    def create_lookup(self, x=18.5, y=-33.9):
+        # Unsaved so no tasks are fired
+        return LookupPointOfInterest(
+            search={"hct": "true"},
+            location=LookupLocation.objects.create(point=Point(x, y)))
+
+    def test_search_internal_query_count_is_constant(self):
+        lookuppoi = self.create_lookup()
+        for count in (3, 60):
+            self.create_clinics(count)
+            with self.assertNumQueries(1):
+                matches = location_finder.search_internal(lookuppoi)
+            self.assertEqual(len(matches), settings.LOCATION_MAX_RESPONSES)
+        self.assertEqual(matches[0], "Clinic 0 ()")
+
+    def test_search_precomputed_reranks_for_lookup_point(self):
+        self.create_clinics(3)
+        far = Location.objects.create(point=Point(18.7, -33.9))
+        PointOfInterest.objects.create(
+            location=far, data={"Clinic Name": "Far Clinic", "hct": "true"})
+        lookuppoi = self.create_lookup(x=18.5002)
+        point = lookuppoi.location.point
+        # Stored in another order, with one outside the radius
+        NearestCell.objects.create(
+            cell=geohash(point.x, point.y,
+                         settings.LOCATION_PRECOMPUTE_PRECISION),
+            category="hct", pointsofinterest=",".join(
+                str(poi.id) for poi in PointOfInterest.objects.order_by(
+                    "-location__id")))
+        with self.settings(LOCATION_SEARCH_RADIUS=5):
+            self.assertEqual(
+                location_finder.search_precomputed(lookuppoi),
+                ["Clinic 2 ()", "Clinic 1 ()"])
+
+    def test_cached_search_shared_within_cell(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        calls = []
+
+        def search(lookuppoi):
+            calls.append(lookuppoi)
+            return ["Clinic"]
+
+        nearby = self.create_lookup(x=18.50001)
+        for lookuppoi in (self.create_lookup(), nearby):
+            self.assertEqual(
+                location_finder.cached_search("test", search, lookuppoi),
+                ["Clinic"])
+        self.assertEqual(len(calls), 1)
+        # Changed clinic data invalidates cached results
+        bump_data_version()
+        location_finder.cached_search("test", search, nearby)
+        self.assertEqual(len(calls), 2)
+
+    def test_pointofinterest_categories_from_data(self):
+        location = Location.objects.create(point=Point(18.5, -33.9))
+        poi = PointOfInterest.objects.create(
+            location=location,
+            data={"Clinic Name": "Clinic", "hct": "true", "mmc": "false"})
+        self.assertEqual(poi.hct, True)
+        self.assertEqual(poi.mmc, False)
+        poi.data["hct"] = ""
+        poi.save()
+        self.assertEqual(PointOfInterest.objects.get(pk=poi.pk).hct, None)
+        self.assertEqual(
+            PointOfInterest.split_search({"hct": "true", "hiv": "false"}),
+            ({"hct": True}, {"hiv": "false"}))
+
+    def test_search_internal_uses_knn_index_scan(self):
+        self.create_clinics(3)
+        lookuppoi = self.create_lookup()
+        matches = location_finder.nearest_candidates(
+            lookuppoi, settings.LOCATION_SEARCH_RADIUS)
+        sql, params = matches.query.sql_with_params()
+        cursor = connection.cursor()
+        # Tiny test tables would otherwise always be scanned
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn("clinicfinder_location_geog_id", plan)
+        # The radius bounds the index scan as well as ordering it
+        self.assertRegexpMatches(plan, r"Index Cond: .*geog && ")
+        self.assertIn("Order By", plan)
+
+
+class TestAATClient(TestCase):
+
+    fixtures = ["test_multi_data.json"]
+
+    def setUp(self):
+        aat_client.reset()
+        caches[settings.AAT_CACHE_ALIAS].clear()
+        self.status = 200
+        self.service = FakeService(self.respond).start()
+        self.addCleanup(self.service.stop)
+        self.addCleanup(aat_client.reset)
+
+    def respond(self, method, path, body):
+        clinics = [{"OrganisationName": "AAT Clinic",
+                    "FullAddress": "AAT Street"}]
+        return (self.status, "application/json",
+                json.dumps({"clinics": clinics}))
+
+    def respond_two_clinics(self, method, path, body):
+        clinics = [{"OrganisationName": "Far Clinic",
+                    "FullAddress": "Far Street", "X": 18.8, "Y": -33.85},
+                   {"OrganisationName": "Near Clinic",
+                    "FullAddress": "Near Street", "X": 18.7, "Y": -33.85}]
+        return (200, "application/json", json.dumps({"clinics": clinics}))
+
+    def create_lookup(self, x=18.71208, y=-33.85105):
+        return LookupPointOfInterest(
+            search={"hct": "true", "source": "aat"},
+            location=LookupLocation.objects.create(point=Point(x, y)))
+
+    def test_search_aat_cached_and_reranked(self):
+        self.service.respond = self.respond_two_clinics
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           AAT_CACHE_GRID=0.1):
+            for x in (18.71208, 18.79):
+                matches = location_finder.search_aat(self.create_lookup(x))
+        self.assertEqual(len(self.service.requests), 1)
+        # Re-ranked for the second point, which is nearer the far clinic
+        self.assertEqual(matches, ["Far Clinic (Far Street)",
+                                   "Near Clinic (Near Street)"])
+
+    def test_search_aat_stale_cache_refreshed(self):
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           AAT_CACHE_FRESH=0):
+            location_finder.search_aat(self.create_lookup())
+            time.sleep(0.01)
+            self.assertEqual(
+                location_finder.search_aat(self.create_lookup()),
+                ["AAT Clinic (AAT Street)"])
+        # The stale hit triggered a refresh
+        self.assertEqual(len(self.service.requests), 2)
+
+    def respond_free_state(self, method, path, body):
+        clinics = [{"OrganisationName": "Tokollo Hospital",
+                    "FullAddress": "Heilbron",
+                    "X": 27.961617, "Y": -27.288878},
+                   {"OrganisationName": "AAT Clinic",
+                    "FullAddress": "AAT Street", "X": 27.975, "Y": -27.29}]
+        return (200, "application/json", json.dumps({"clinics": clinics}))
+
+    def create_hybrid_lookup(self):
+        return LookupPointOfInterest(
+            search={"mmc": "true", "source": "hybrid"},
+            location=LookupLocation.objects.create(
+                point=Point(27.97, -27.29)))
+
+    def test_search_hybrid_merges_sources(self):
+        self.service.respond = self.respond_free_state
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations"):
+            matches = location_finder.search_hybrid(
+                self.create_hybrid_lookup())
+        self.assertEqual(matches, [
+            "AAT Clinic (AAT Street)",
+            "Tokollo Hospital (Myron Street, Heilbron, 058 813 1391)"])
+
+    def test_search_hybrid_deadline(self):
+        self.service.respond = self.respond_free_state
+        self.service.latency = 1
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           LOCATION_HYBRID_DEADLINE=0.2):
+            started = time.time()
+            matches = location_finder.search_hybrid(
+                self.create_hybrid_lookup())
+            self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(matches, [
+            "Tokollo Hospital (Myron Street, Heilbron, 058 813 1391)"])
+
+    def test_search_hybrid_deadline_not_cached(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        self.service.latency = 1
+        lookuppoi = self.create_hybrid_lookup()
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           LOCATION_HYBRID_DEADLINE=0.2):
+            location_finder.cached_search(
+                "hybrid", location_finder.search_hybrid, lookuppoi)
+        # Missing AAT's results leaves the next lookup to try again
+        self.assertIsNone(
+            cache.get(location_finder.cache_key("hybrid", lookuppoi)))
+
+    def test_search_aat_reuses_connection(self):
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           AAT_CACHE_ENABLED=False):
+            for i in range(3):
+                self.assertEqual(
+                    location_finder.search_aat(self.create_lookup()),
+                    ["AAT Clinic (AAT Street)"])
+        self.assertEqual(len(self.service.requests), 3)
+        client_addresses = set(
+            request[0] for request in self.service.requests)
+        self.assertEqual(len(client_addresses), 1)
+
+    def test_search_aat_failure_opens_circuit(self):
+        self.status = 500
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           AAT_RETRIES=0, AAT_CIRCUIT_THRESHOLD=2):
+            for i in range(4):
+                # Falls back to the internal search
+                self.assertEqual(
+                    location_finder.search_aat(self.create_lookup()),
+                    ["Harmonie Clinic (0219806185/6205)",
+                     "Hazendal Satellite Clinic (216969920)"])
+        self.assertEqual(len(self.service.requests), 2)
+
+    def test_search_aat_fallback_not_cached(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        self.status = 500
+        with self.settings(AAT_API_URL=self.service.url + "/GetLocations",
+                           AAT_RETRIES=0):
+            self.assertEqual(
+                location_finder.cached_search(
+                    "aat", location_finder.search_aat, self.create_lookup()),
+                ["Harmonie Clinic (0219806185/6205)",
+                 "Hazendal Satellite Clinic (216969920)"])
+            # AAT's results are used and cached once it recovers
+            self.status = 200
+            for i in range(2):
+                self.assertEqual(
+                    location_finder.cached_search(
+                        "aat", location_finder.search_aat,
+                        self.create_lookup()),
+                    ["AAT Clinic (AAT Street)"])
+        self.assertEqual(len(self.service.requests), 2)
+
+class TestLBSClient(TestCase):
+
+    def setUp(self):
+        lbs_client.reset()
+        self.lbs = FakeLBS().start()
+        self.addCleanup(self.lbs.stop)
+        self.addCleanup(lbs_client.reset)
+        self.wsdl_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.wsdl_cache)
+
+    def test_wsdl_parsed_once_and_connection_reused(self):
+        with self.settings(LBS_API_WSDL=self.lbs.wsdl_url,
+                           LBS_API_WSDL_CACHE=self.wsdl_cache):
+            client = lbs_client.get_client()
+            self.assertIs(lbs_client.get_client(), client)
+            for i in range(2):
+                result = client.service.GetLocation(
+                    username="", password="", msisdn="27123")
+        self.assertEqual(result[0][0]["_code"], "101")
+        requests = self.lbs.service.requests
+        self.assertEqual([request[1] for request in requests],
+                         ["GET", "POST", "POST"])
+        self.assertEqual(len(set(request[0] for request in requests)), 1)
+
+
+class TestLBSRateLimiter(TestCase):
+
+    def setUp(self):
+        lbs_rate_limiter.reset()
+        self.addCleanup(lbs_rate_limiter.reset)
+
+    @override_settings(LBS_API_RATE_LIMIT=10, LBS_API_RATE_BURST=2)
+    def test_waits_once_burst_used(self):
+        with mock.patch("clinicfinder.clients.time") as clock:
+            clock.time.return_value = 100.0
+            waits = [lbs_rate_limiter.acquire() for i in range(4)]
+            self.assertEqual(waits, [0, 0, 0.1, 0.2])
+            clock.time.return_value = 101.0
+            self.assertEqual(lbs_rate_limiter.acquire(), 0)
+
+    @override_settings(LBS_API_RATE_LIMIT=10, LBS_API_RATE_BURST=1)
+    def test_bucket_shared_between_workers(self):
+        other_worker = RateLimiter()
+        with mock.patch("clinicfinder.clients.time") as clock:
+            clock.time.return_value = 100.0
+            self.assertEqual(lbs_rate_limiter.acquire(), 0)
+            self.assertEqual(other_worker.acquire(), 0.1)
+
+    @override_settings(LBS_API_RATE_LIMIT=None)
+    def test_unlimited(self):
+        with mock.patch("clinicfinder.clients.time") as clock:
+            for i in range(20):
+                self.assertEqual(lbs_rate_limiter.acquire(), 0)
+        self.assertFalse(clock.sleep.called)
+
+
+class TestMetricsBuffer(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.send = mock.Mock()
+        self.buffer = MetricsBuffer(self.send)
+        self.addCleanup(self.buffer.reset)
+
+    def test_aggregates_until_flushed(self):
+        with override_settings(METRICS_BUFFER_ENABLED=True,
+                               METRICS_BUFFER_PATH=self.path,
+                               METRICS_FLUSH_SIZE=100,
+                               METRICS_FLUSH_INTERVAL=60):
+            self.buffer.record("sms.results", 1, "sum")
+            self.buffer.record("sms.results", 1, "sum")
+            self.buffer.record("lbs.soap.setup_ms", 10, "avg")
+            self.buffer.record("lbs.soap.setup_ms", 20, "avg")
+            self.assertFalse(self.send.called)
+            self.assertEqual(self.buffer.flush(), 2)
+        self.send.assert_called_once_with([
+            ["lbs.soap.setup_ms", 15.0, "avg"],
+            ["sms.results", 2.0, "sum"],
+        ])
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_flushes_at_size(self):
+        with override_settings(METRICS_BUFFER_ENABLED=True,
+                               METRICS_BUFFER_PATH=self.path,
+                               METRICS_FLUSH_SIZE=3,
+                               METRICS_FLUSH_INTERVAL=60):
+            for i in range(3):
+                self.buffer.record("sms.results", 1, "sum")
+        self.send.assert_called_once_with([["sms.results", 3.0, "sum"]])
+
+    def test_disabled_sends_each_metric(self):
+        with override_settings(METRICS_BUFFER_ENABLED=False):
+            self.buffer.record("sms.results", 1, "sum")
+        self.send.assert_called_once_with([["sms.results", 1, "sum"]])
+
+    def test_keeps_values_when_send_fails(self):
+        self.send.side_effect = [Exception("Vumi Go is down"), None]
+        with override_settings(METRICS_BUFFER_ENABLED=True,
+                               METRICS_BUFFER_PATH=self.path,
+                               METRICS_FLUSH_SIZE=100,
+                               METRICS_FLUSH_INTERVAL=60):
+            self.buffer.record("sms.results", 1, "sum")
+            self.assertEqual(self.buffer.flush(), 0)
+            self.buffer.record("sms.results", 1, "sum")
+            self.assertEqual(self.buffer.flush(), 1)
+        self.send.assert_called_with([["sms.results", 2.0, "sum"]])
+
+    def test_recovers_metrics_of_exited_worker(self):
+        with override_settings(METRICS_BUFFER_PATH=self.path):
+            with open(self.buffer.filename(999999), "w") as f:
+                json.dump([["sms.results", "sum", 4, 4]], f)
+            with mock.patch.object(self.buffer, "is_running",
+                                   return_value=False):
+                self.buffer.recover()
+            self.assertEqual(os.listdir(self.path), [])
+            self.assertEqual(self.buffer.flush(), 1)
+        self.send.assert_called_once_with([["sms.results", 4, "sum"]])
+
+    def test_metric_sender_fires_batch(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        result = metric_sender.delay(metrics=[
+            ["sms.results", 2, "sum"], ["lbs.soap.setup_ms", 15, "avg"]])
+        self.assertTrue(result.successful())
+        self.assertEquals(result.get()["reason"], "Metrics published")
+
+
+class TestVumiClient(TestCase):
+
+    def setUp(self):
+        vumi_client.reset()
+        self.addCleanup(vumi_client.reset)
+
+    def test_senders_share_connections(self):
+        vumi = FakeVumi().start()
+        self.addCleanup(vumi.stop)
+        with override_settings(VUMI_GO_API_URL=vumi.url):
+            for i in range(5):
+                vumi_client.get_sender().send_text("+27123", "Clinic")
+        self.assertEqual(len(vumi.messages), 5)
+        self.assertEqual(len(vumi.service.server.connections), 1)
+
+    def test_retries_gateway_errors(self):
+        statuses = [503, 200]
+
+        def respond(method, path, body):
+            return (statuses.pop(0), "application/json",
+                    json.dumps({"success": True}))
+
+        service = FakeService(respond).start()
+        self.addCleanup(service.stop)
+        with override_settings(VUMI_GO_API_URL=service.url,
+                               VUMI_GO_RETRY_BACKOFF=0):
+            result = vumi_client.get_sender().send_text("+27123", "Clinic")
+        self.assertTrue(result["success"])
+        self.assertEqual(len(service.requests), 2)
+
+    def test_batch_sender_keeps_lookup_vumi_fails_for(self):
+        Metric_Sender.vumi_client = lambda x: LoggingSender('go_http.test')
+        cache.clear()
+        vumi = FakeVumi(status=503).start()
+        self.addCleanup(vumi.stop)
+        lookuppoi = LookupPointOfInterest(id=1, response={
+            "type": "SMS", "to_addr": "+27123", "results": "Clinic",
+            "template": "Your nearest clinic is: {{ results }}"})
+        with override_settings(VUMI_GO_API_URL=vumi.url, VUMI_GO_RETRIES=1,
+                               VUMI_GO_RETRY_BACKOFF=0), \
+                mock.patch.object(Location_Sender, "vumi_client",
+                                  lambda x: vumi_client.get_sender()):
+            # Left unsent for a later batch once retries are used up
+            self.assertIsNone(location_batch_sender.send(lookuppoi))
+            self.assertNotIn("sent", lookuppoi.response)
+            self.assertEqual(len(vumi.service.requests), 2)
+            vumi.status = 200
+            self.assertIsNotNone(location_batch_sender.send(lookuppoi))
+        self.assertEqual(lookuppoi.response["sent"], "true")
+        self.assertEqual(len(vumi.messages), 3)
+
+class TestTaskRouting(TestCase):
+
+    def route(self, task):
+        options = task.app.amqp.router.route({}, task.name)
+        return options["queue"].name, options.get("priority")
+
+    def test_live_lookups_have_own_queues(self):
+        self.assertEqual(self.route(lbs_lookup), ("clinicfinder_lbs", 0))
+        self.assertEqual(self.route(location_finder),
+                         ("clinicfinder_search", 0))
+        self.assertEqual(self.route(location_sender),
+                         ("clinicfinder_send", 0))
+        self.assertEqual(self.route(pointofinterest_importer),
+                         ("clinicfinder_imports", 9))
+        self.assertEqual(self.route(metric_sender),
+                         ("clinicfinder_metrics", 6))
+
+    def test_every_queue_has_workers(self):
+        consumed = set()
+        for profile in settings.WORKER_PROFILES.values():
+            consumed.update(profile["queues"])
+        self.assertEqual(consumed,
+                         set(queue.name for queue in settings.CELERY_QUEUES))
+
+
+class TestTaskResults(TestCase):
+
+    def test_fire_and_forget_results_ignored(self):
+        self.assertTrue(metric_sender.ignore_result)
+        self.assertTrue(location_sender.ignore_result)
+        self.assertFalse(pointofinterest_importer.ignore_result)
+
+    @override_settings(TASK_RESULT_PURGE_AGE=3600,
+                       TASK_RESULT_PURGE_BATCH_SIZE=2,
+                       TASK_RESULT_PURGE_PAUSE=0)
+    def test_purger_deletes_old_results_in_batches(self):
+        for i in range(5):
+            TaskMeta.objects.create(task_id="old-%s" % i)
+        TaskMeta.objects.create(task_id="new")
+        TaskMeta.objects.filter(task_id__startswith="old-").update(
+            date_done=timezone.now() - timedelta(hours=2))
+        with mock.patch.object(task_result_purger, "purge",
+                               wraps=task_result_purger.purge) as purge:
+            self.assertEqual(task_result_purger.delay().get(), 5)
+        # Three batches of results then one of result sets
+        self.assertEqual(purge.call_count, 4)
+        self.assertEqual(
+            list(TaskMeta.objects.values_list("task_id", flat=True)),
+            ["new"])
+
+
+class TestLBSWhitelist(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def patch_lbs(self, location_codes):
+        calls = []
+        codes = iter(location_codes)
+
+        def add_allowed_msisdn(lookup, msisdn):
+            calls.append("AddAllowedMsisdn")
+            return {"_code": "101", "_message": "Allowed"}
+
+        def get_location(lookup, msisdn):
+            calls.append("GetLocation")
+            return {"_code": next(codes), "_message": "Location",
+                    "x": 18.5, "y": -33.9}
+
+        for name, stub in (("add_allowed_msisdn", add_allowed_msisdn),
+                           ("get_location", get_location)):
+            patcher = mock.patch.object(LBS_Lookup, name, stub)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return calls
+
+    def test_whitelist_skipped_when_recent(self):
+        calls = self.patch_lbs(["101", "101"])
+        lbs_lookup.whitelisted_location("+27123")
+        whitelist, result = lbs_lookup.whitelisted_location("27123")
+        self.assertEqual(whitelist["_code"], "101")
+        self.assertEqual(result["_code"], "101")
+        self.assertEqual(calls, ["AddAllowedMsisdn", "GetLocation",
+                                 "GetLocation"])
+
+    def test_whitelist_retried_when_lookup_refused(self):
+        calls = self.patch_lbs(["101", "201", "101"])
+        lbs_lookup.whitelisted_location("27123")
+        whitelist, result = lbs_lookup.whitelisted_location("27123")
+        self.assertEqual(result["_code"], "101")
+        self.assertEqual(calls, ["AddAllowedMsisdn", "GetLocation",
+                                 "GetLocation", "AddAllowedMsisdn",
+                                 "GetLocation"])
+
+    def test_whitelist_kept_when_lookup_fails_otherwise(self):
+        calls = self.patch_lbs(["101", "301"])
+        lbs_lookup.whitelisted_location("27123")
+        whitelist, result = lbs_lookup.whitelisted_location("27123")
+        self.assertEqual(result["_code"], "301")
+        self.assertEqual(calls, ["AddAllowedMsisdn", "GetLocation",
+                                 "GetLocation"])
+
+class TestBenchmarkPipeline(TestCase):
+
+    def test_summarise_percentiles(self):
+        summary = summarise([float(i) for i in range(100, 0, -1)])
+        self.assertEqual(
+            (summary["p50"], summary["p95"], summary["p99"], summary["max"]),
+            (50, 95, 99, 100))
+
+    def test_fake_vumi_accepts_messages_and_metrics(self):
+        vumi = FakeVumi().start()
+        self.addCleanup(vumi.stop)
+        sender = HttpApiSender("acc-key", "conv-key", "conv-token",
+                               api_url=vumi.url)
+        sender.send_text("+27123", "Your nearest clinic")
+        result = sender.fire_metric("sms.results", 1, agg="sum")
+        self.assertTrue(result["success"])
+        self.assertEqual([message["to_addr"] for message in vumi.messages],
+                         ["+27123"])
+
 
 class TestClinicFinderDistanceSorting(AuthenticatedAPITestCase):
 
@@ -13,6 +13,9 @@ router.register(r'lbsrequest', views.LBSRequestViewSet)
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
     url(r'^', include(router.urls)),
+    url(r'^nearest/$', views.NearestClinicView.as_view(), name='nearest'),
+    url(r'^report/latency/$', views.StageLatencyView.as_view(),
+        name='stage-latency'),
     url(r'^api-auth/',
         include('rest_framework.urls', namespace='rest_framework')),
     url(r'^api-token-auth/',
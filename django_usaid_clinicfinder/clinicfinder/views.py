@@ -1,16 +1,26 @@
 from .models import (PointOfInterest, Location, LookupLocation,
                      LookupPointOfInterest, LBSRequest)
-from rest_framework import viewsets
+import time
+from datetime import timedelta
+from rest_framework import status, viewsets
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from .serializers import (PointOfInterestSerializer, LocationSerializer,
                           LookupPointOfInterestSerializer,
                           LookupLocationSerializer, LBSRequestSerializer)
 from .forms import LocationsCSVUploader
+from .reports import stage_latency
+from .tasks import location_finder, metrics_buffer
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.contrib import messages
 from django.core.context_processors import csrf
+from django.db import OperationalError
+from django.utils import timezone
+from psycopg2 import errorcodes
 
 
 class LocationViewSet(viewsets.ModelViewSet):
@@ -63,6 +73,88 @@ class LBSRequestViewSet(viewsets.ModelViewSet):
     serializer_class = LBSRequestSerializer
 
 
+class NearestClinicView(APIView):
+
+    """
+    API endpoint returning the clinics nearest ?lon=&lat= straight away,
+    ranked and formatted as they are sent by SMS. Other parameters
+    filter the clinics as a lookup's search does, e.g. mmc=true, and
+    ?source= picks one of NEAREST_API_SOURCES. Nothing is stored and no
+    lookup tasks are queued. Searches over NEAREST_API_BUDGET_MS are
+    cancelled with a 503.
+    """
+    permission_classes = (IsAuthenticated,)
+    RESERVED_PARAMS = ("lon", "lat", "source", "format")
+
+    def get(self, request, format=None):
+        params = request.QUERY_PARAMS
+        errors = {}
+        point = {}
+        for name, limit in (("lon", 180), ("lat", 90)):
+            try:
+                point[name] = float(params[name])
+                if abs(point[name]) > limit:
+                    raise ValueError()
+            except (KeyError, ValueError):
+                errors[name] = ["A number from -%s to %s is required." % (
+                    limit, limit)]
+        source = params.get("source", settings.NEAREST_API_SOURCE)
+        if source not in settings.NEAREST_API_SOURCES:
+            errors["source"] = ["One of %s is required." % ", ".join(
+                settings.NEAREST_API_SOURCES)]
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        search = dict((key, value) for key, value in params.items()
+                      if key not in self.RESERVED_PARAMS)
+        search["source"] = source
+        started = time.time()
+        try:
+            matches = location_finder.find_nearest(
+                point["lon"], point["lat"], search)
+        except OperationalError as e:
+            # Only a search cancelled by the statement timeout is over
+            # budget, other database errors are errors
+            cause = getattr(e, "__cause__", None)
+            if getattr(cause, "pgcode", None) != errorcodes.QUERY_CANCELED:
+                raise
+            metrics_buffer.record("nearest.over_budget", 1, "sum")
+            return Response(
+                {"detail": "Search took longer than %sms." %
+                 settings.NEAREST_API_BUDGET_MS},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({
+            "results": matches,
+            "source": source,
+            "took_ms": round((time.time() - started) * 1000, 1),
+        })
+
+
+class StageLatencyView(APIView):
+
+    """
+    API endpoint reporting p50/p95/p99 milliseconds spent queued and
+    running in each pipeline stage, for requests created in the last
+    ?minutes= (LATENCY_REPORT_MINUTES by default).
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, format=None):
+        try:
+            minutes = float(request.QUERY_PARAMS.get(
+                "minutes", settings.LATENCY_REPORT_MINUTES))
+        except ValueError:
+            return Response({"minutes": ["A number is required."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        until = timezone.now()
+        since = until - timedelta(minutes=minutes)
+        return Response({
+            "since": since,
+            "until": until,
+            "stages": stage_latency(since, until),
+        })
+
+
 @staff_member_required
 def locations_uploader(request, page_name):
     if request.method == "POST":
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 """
 
 import os
+from datetime import timedelta
 
 import dj_database_url
 
@@ -129,12 +130,68 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ('rest_framework.filters.DjangoFilterBackend',)
 }
 
+# Shared by every web and worker process so data version bumps,
+# coalescing claims and batch schedules are seen by all of them. Run
+# Redis with maxmemory and maxmemory-policy volatile-lru: cache entries
+# all expire so they are evicted least recently used first, while the
+# broker's queues never are.
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/2',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+    # AAT results are kept for days, so in their own database that
+    # Redis persistence (RDB or AOF) keeps across restarts. Shared so a
+    # background refresh updates the copy every worker serves.
+    'aat': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/3',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+
 # Celery configuration options
-CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
+# Results are kept in Redis until they expire rather than in Postgres
+CELERY_RESULT_BACKEND = 'redis://localhost:6379/1'
+CELERY_TASK_RESULT_EXPIRES = 3600  # seconds
 CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'
 
 BROKER_URL = 'redis://localhost:6379/0'
 
+# Fire and forget tasks nobody reads the result of. Failures are still
+# stored so they can be looked into.
+CELERY_IGNORED_RESULT_TASKS = (
+    'clinicfinder.tasks.metric_sender',
+    'clinicfinder.tasks.lbs_lookup',
+    'clinicfinder.tasks.lbs_batch_lookup',
+    'clinicfinder.tasks.lbs_pipeline',
+    'clinicfinder.tasks.location_finder',
+    'clinicfinder.tasks.location_sender',
+    'clinicfinder.tasks.location_batch_sender',
+    'clinicfinder.tasks.aat_cache_refresher',
+)
+CELERY_ANNOTATIONS = dict(
+    (name, {'ignore_result': True}) for name in CELERY_IGNORED_RESULT_TASKS)
+CELERY_STORE_ERRORS_EVEN_IF_IGNORED = True
+
+# Results left in the djcelery tables by the database backend are
+# deleted in batches once older than TASK_RESULT_PURGE_AGE
+TASK_RESULT_PURGE_AGE = 86400  # seconds
+TASK_RESULT_PURGE_BATCH_SIZE = 1000
+TASK_RESULT_PURGE_PAUSE = 0.1  # seconds between batches
+TASK_RESULT_PURGE_TIME = 300  # seconds a run may take, the rest waits
+CELERYBEAT_SCHEDULE = {
+    'purge-task-results': {
+        'task': 'clinicfinder.tasks.task_result_purger',
+        'schedule': timedelta(hours=1),
+    },
+}
+
 from kombu import Exchange, Queue
 
 CELERY_DEFAULT_QUEUE = 'django_usaid_clinicfinder'
@@ -142,7 +199,70 @@ CELERY_QUEUES = (
     Queue('django_usaid_clinicfinder',
           Exchange('django_usaid_clinicfinder'),
           routing_key='django_usaid_clinicfinder'),
+    Queue('clinicfinder_lbs',
+          Exchange('clinicfinder_lbs'),
+          routing_key='clinicfinder_lbs'),
+    Queue('clinicfinder_search',
+          Exchange('clinicfinder_search'),
+          routing_key='clinicfinder_search'),
+    Queue('clinicfinder_send',
+          Exchange('clinicfinder_send'),
+          routing_key='clinicfinder_send'),
+    Queue('clinicfinder_metrics',
+          Exchange('clinicfinder_metrics'),
+          routing_key='clinicfinder_metrics'),
+    Queue('clinicfinder_imports',
+          Exchange('clinicfinder_imports'),
+          routing_key='clinicfinder_imports'),
 )
+# Each stage has its own queue so imports and metrics never sit in front
+# of live lookups. Redis serves priority 0 first, background work sharing
+# a queue with the live path runs at a lower priority.
+CELERY_ROUTES = {
+    'clinicfinder.tasks.lbs_lookup': {
+        'queue': 'clinicfinder_lbs', 'priority': 0},
+    'clinicfinder.tasks.lbs_batch_lookup': {
+        'queue': 'clinicfinder_lbs', 'priority': 0},
+    'clinicfinder.tasks.lbs_pipeline': {
+        'queue': 'clinicfinder_lbs', 'priority': 0},
+    'clinicfinder.tasks.location_finder': {
+        'queue': 'clinicfinder_search', 'priority': 0},
+    'clinicfinder.tasks.aat_cache_refresher': {
+        'queue': 'clinicfinder_search', 'priority': 6},
+    'clinicfinder.tasks.location_sender': {
+        'queue': 'clinicfinder_send', 'priority': 0},
+    'clinicfinder.tasks.location_batch_sender': {
+        'queue': 'clinicfinder_send', 'priority': 0},
+    'clinicfinder.tasks.metric_sender': {
+        'queue': 'clinicfinder_metrics', 'priority': 6},
+    'clinicfinder.tasks.pointofinterest_importer': {
+        'queue': 'clinicfinder_imports', 'priority': 9},
+    'clinicfinder.tasks.nearest_precomputer': {
+        'queue': 'clinicfinder_imports', 'priority': 9},
+    'clinicfinder.tasks.task_result_purger': {
+        'queue': 'clinicfinder_imports', 'priority': 9},
+}
+# Workers take one task at a time so priorities apply and a long import
+# never holds back tasks reserved behind it
+CELERYD_PREFETCH_MULTIPLIER = 1
+# Worker processes to start per group of queues, see README.rst. The
+# LBS SOAP and Vumi Go stages mostly wait on the network, searches are
+# bound by PostGIS so stay near the database's cores.
+WORKER_PROFILES = {
+    'io': {
+        'queues': ['clinicfinder_lbs', 'clinicfinder_send'],
+        'concurrency': 16,
+    },
+    'search': {
+        'queues': ['clinicfinder_search'],
+        'concurrency': 4,
+    },
+    'background': {
+        'queues': ['clinicfinder_imports', 'clinicfinder_metrics',
+                   'django_usaid_clinicfinder'],
+        'concurrency': 2,
+    },
+}
 
 CELERY_ALWAYS_EAGER = False
 
@@ -158,10 +278,92 @@ CELERY_ACCEPT_CONTENT = ['json']
 VUMI_GO_ACCOUNT_KEY = ""
 VUMI_GO_CONVERSATION_KEY = ""
 VUMI_GO_ACCOUNT_TOKEN = ""
+VUMI_GO_API_URL = "https://go.vumi.org/api/v1/go/http_api_nostream"
+VUMI_GO_CONNECT_TIMEOUT = 3.05  # seconds
+VUMI_GO_READ_TIMEOUT = 10  # seconds
+VUMI_GO_RETRIES = 3
+VUMI_GO_RETRY_BACKOFF = 0.2  # seconds, doubled on each retry
+VUMI_GO_POOL_SIZE = 10
+# 'single' sends each message in its own task, 'batch' sends searched
+# lookups in groups of LOCATION_SEND_BATCH_SIZE on VUMI_GO_POOL_SIZE
+# threads
+LOCATION_SEND_MODE = 'single'
+LOCATION_SEND_BATCH_SIZE = 100
+LOCATION_SEND_BATCH_DELAY = 2  # seconds to collect messages
+# Seconds before messages Vumi Go could not be reached for are retried
+LOCATION_SEND_RETRY_DELAY = 30
+# The nearest clinic API answers inline, so only sources that do not
+# call out to AAT are offered. 'index' is left out as loading it reads
+# the whole clinic table, which the budget would cancel every time.
+NEAREST_API_SOURCE = 'internal'
+NEAREST_API_SOURCES = ('internal', 'knn', 'precomputed')
+NEAREST_API_BUDGET_MS = 300  # database time before a search is cancelled
+# Minutes of requests the stage latency report covers by default
+LATENCY_REPORT_MINUTES = 60
+# Metrics are aggregated per worker and fired as one batch
+METRICS_BUFFER_ENABLED = True
+METRICS_FLUSH_INTERVAL = 10  # seconds
+METRICS_FLUSH_SIZE = 500  # events
+# Unsent metrics are kept here, None uses the temp directory
+METRICS_BUFFER_PATH = None
 LOCATION_RESPONSE_MAX_LENGTH = 320
 LOCATION_NONE_FOUND = "Sorry, no locations found. Please try again later."
 LOCATION_MAX_RESPONSES = 2
 LOCATION_SEARCH_RADIUS = 10  # KM
+# 'knn' searches return the nearest clinics up to this far away
+LOCATION_KNN_MAX_RADIUS = 160  # KM
+# Search source used when a lookup does not specify one:
+# 'internal' (PostGIS), 'knn' (nearest, wider radius), 'index' (in-memory),
+# 'precomputed' (per grid cell table), 'aat' or 'hybrid' (internal and
+# AAT together)
+LOCATION_DEFAULT_SOURCE = 'internal'
+LOCATION_INDEX_CELL_SIZE = 0.1  # degrees
+LOCATION_INDEX_MAX_AGE = 3600  # seconds before a forced reload
+# Filter hct/mmc on PointOfInterest's typed columns, not the hstore
+LOCATION_TYPED_FILTERS = True
+# Share search results between lookups in the same geohash cell
+LOCATION_CACHE_ENABLED = True
+LOCATION_CACHE_PRECISION = 7  # geohash characters, 7 is ~150m
+LOCATION_CACHE_TIMEOUT = 3600  # seconds
+# Grid for the 'precomputed' source, 6 is ~1.2km x 0.6km cells
+LOCATION_PRECOMPUTE_PRECISION = 6
+LOCATION_PRECOMPUTE_TOP_K = 5
+LOCATION_PRECOMPUTE_ON_IMPORT = True
+# 'hybrid' searches stop waiting for AAT after this many seconds
+LOCATION_HYBRID_DEADLINE = 2.0
+# Same named clinics closer than this are treated as one
+LOCATION_HYBRID_DUPLICATE_DISTANCE = 0.5  # KM
+# Repeat LBS requests for the same MSISDN and search within this many
+# seconds share the first one's results, and identical SMSes are only
+# sent once. 0 turns this off.
+LOCATION_COALESCE_WINDOW = 120
+
+LBS_API_TIMEOUT = 30  # seconds
+LBS_API_POOL_SIZE = 10
+# Parsed WSDL cache, None uses the suds default temp directory
+LBS_API_WSDL_CACHE = None
+LBS_API_WSDL_CACHE_DAYS = 7
+# Skip AddAllowedMsisdn for MSISDNs whitelisted within this many seconds
+LBS_WHITELIST_TIMEOUT = 86400
+# GetLocation codes meaning the MSISDN is no longer allowed, which
+# whitelist it again. Any other failure is recorded as it is.
+LBS_API_PERMISSION_ERRORS = ("201",)
+# Reuse a location found for the same MSISDN within this many seconds,
+# 0 always calls the LBS API
+LBS_LOCATION_REUSE_WINDOW = 300
+# 'single' runs a task per LBS request, 'batch' queues them and looks
+# them up in groups of LBS_BATCH_SIZE on LBS_BATCH_WORKERS threads,
+# 'pipeline' looks up, searches and sends in one task per request
+LBS_LOOKUP_MODE = 'single'
+LBS_BATCH_SIZE = 50
+LBS_BATCH_WORKERS = 10
+LBS_BATCH_DELAY = 2  # seconds to collect requests before a batch runs
+# Requests claimed by a batch that has not finished them by then are
+# claimed again, in case its worker died
+LBS_BATCH_CLAIM_TIMEOUT = 300  # seconds
+# SOAP calls a second across all workers, None for no limit
+LBS_API_RATE_LIMIT = None
+LBS_API_RATE_BURST = 10
 
 AAT_API_URL = "https://api-info4africa.aat.co.za/api/lookup/GetLocations"
 AAT_USERNAME = ''
@@ -171,6 +373,21 @@ AAT_CATEGORIES = {
     'mmc': '73',
 }
 AAT_DEFAULT_CATEGORY = 'mmc'
+AAT_CONNECT_TIMEOUT = 3.05  # seconds
+AAT_READ_TIMEOUT = 10  # seconds
+AAT_RETRIES = 2
+AAT_RETRY_BACKOFF = 0.2  # seconds, doubled on each retry
+AAT_POOL_SIZE = 10
+# Skip AAT for AAT_CIRCUIT_RESET seconds after this many failures in a row
+AAT_CIRCUIT_THRESHOLD = 5
+AAT_CIRCUIT_RESET = 60
+# Cache AAT results per category and AAT_CACHE_GRID degree square
+AAT_CACHE_ENABLED = True
+AAT_CACHE_ALIAS = 'aat'
+AAT_CACHE_GRID = 0.01  # degrees, about 1km
+AAT_CACHE_FRESH = 86400  # seconds before a background refresh
+AAT_CACHE_TIMEOUT = 604800  # seconds before a stale entry is dropped
+AAT_CACHE_REFRESH_LOCK = 60  # seconds
 
 try:
     from local_settings import *
@@ -18,6 +18,20 @@ CELERY_ALWAYS_EAGER = True
 BROKER_BACKEND = 'memory'
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 
+# Tests run in one process so need no shared cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'aat': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'aat',
+    },
+}
+
+# Fire metrics as they happen so tests can see them
+METRICS_BUFFER_ENABLED = False
+
 LBS_API_WSDL = "https://lbs.gsm.co.za/lbsservice.asmx?WSDL"
 LBS_API_USERNAME = ""
 LBS_API_PASSWORD = ""